@@ -0,0 +1,70 @@
+import os
+
+from . import db
+
+DB_POOL_SIZE = int(os.environ.get("LDTVOUCHERS_DB_POOL_SIZE", 4))
+DB_POOL_TIMEOUT = float(os.environ.get("LDTVOUCHERS_DB_POOL_TIMEOUT", 30))
+
+# Seconds from importing the application to serving requests, above which a
+# warning is printed
+STARTUP_BUDGET_SECONDS = float(os.environ.get("LDTVOUCHERS_STARTUP_BUDGET_SECONDS", 2))
+
+AUTH_CACHE_TTL = float(os.environ.get("LDTVOUCHERS_AUTH_CACHE_TTL", 300))
+
+# Where voucher states are stored: "column" updates vouchers.state along with
+# each history row, "history" only appends to history. See app/states.py.
+STATE_STORES = ("column", "history")
+STATE_STORE = os.environ.get("LDTVOUCHERS_STATE_STORE", "column")
+if STATE_STORE not in STATE_STORES:
+    raise ValueError(
+        f"LDTVOUCHERS_STATE_STORE must be one of {', '.join(STATE_STORES)}"
+    )
+
+# Seconds a scan's Idempotency-Key is remembered
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("LDTVOUCHERS_IDEMPOTENCY_KEY_TTL", 86400))
+
+# Rows fetched per chunk when streaming report exports
+REPORT_FETCH_SIZE = int(os.environ.get("LDTVOUCHERS_REPORT_FETCH_SIZE", 500))
+
+# Opt-in SQL tracing, see app/tracing.py: Server-Timing headers, and a log of
+# the statements slower than SLOW_QUERY_SECONDS with their query plan
+SQL_TRACE = bool(int(os.environ.get("LDTVOUCHERS_SQL_TRACE", 0)))
+SLOW_QUERY_SECONDS = float(os.environ.get("LDTVOUCHERS_SLOW_QUERY_SECONDS", 0.1))
+
+# QR codes kept in memory by app/qrcodes.py, per format
+QRCODE_CACHE_SIZE = int(os.environ.get("LDTVOUCHERS_QRCODE_CACHE_SIZE", 4096))
+
+# Durability profiles set journal_mode and synchronous. In WAL mode readers,
+# e.g. the report queries, never block the tills, and synchronous=NORMAL
+# only fsyncs at checkpoints: a power loss may roll back the last commits
+# but does not corrupt the database.
+DB_DURABILITY_PROFILES = {
+    "safe": {"journal_mode": "wal", "synchronous": "full"},
+    "balanced": {"journal_mode": "wal", "synchronous": "normal"},
+    # Never fsyncs: an OS crash or a power loss may corrupt the database,
+    # only for benchmarks and throwaway databases
+    "fast": {"journal_mode": "wal", "synchronous": "off"},
+    "legacy": {"journal_mode": "delete", "synchronous": "full"},
+}
+DB_DURABILITY = os.environ.get("LDTVOUCHERS_DB_DURABILITY", "balanced")
+if DB_DURABILITY not in DB_DURABILITY_PROFILES:
+    raise ValueError(
+        "LDTVOUCHERS_DB_DURABILITY must be one of "
+        f"{', '.join(DB_DURABILITY_PROFILES)}"
+    )
+
+DB_PRAGMAS = {
+    **DB_DURABILITY_PROFILES[DB_DURABILITY],
+    "busy_timeout": 5000,  # milliseconds
+    "cache_size": -16000,  # negative: KiB
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "memory",
+}
+for pragma in DB_PRAGMAS:
+    if f"LDTVOUCHERS_DB_{pragma.upper()}" in os.environ:
+        try:
+            DB_PRAGMAS[pragma] = db.pragma_value(
+                pragma, os.environ[f"LDTVOUCHERS_DB_{pragma.upper()}"]
+            )
+        except ValueError as err:
+            raise ValueError(f"LDTVOUCHERS_DB_{pragma.upper()}: {err}")
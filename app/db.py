@@ -0,0 +1,154 @@
+import asyncio
+import functools
+import queue
+import threading
+
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from sqlite3 import Connection, Error
+from typing import Callable, Iterator, Mapping, Union
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# PRAGMA values cannot be bound as parameters: only known values are accepted
+_PRAGMA_VALUES = {
+    "journal_mode": {"delete", "truncate", "persist", "memory", "wal", "off"},
+    "synchronous": {"off", "normal", "full", "extra"},
+    "temp_store": {"default", "file", "memory"},
+    "busy_timeout": int,
+    "cache_size": int,
+    "mmap_size": int,
+}
+
+
+def pragma_value(pragma: str, value: Union[str, int]) -> Union[str, int]:
+    """Return `value` normalized, raising ValueError if `pragma` does not
+    accept it."""
+    try:
+        allowed = _PRAGMA_VALUES[pragma]
+    except KeyError:
+        raise ValueError(f"Unsupported PRAGMA {pragma}")
+    if allowed is int:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"Invalid value for PRAGMA {pragma}: {value!r}")
+    if str(value).lower() not in allowed:
+        raise ValueError(f"Invalid value for PRAGMA {pragma}: {value!r}")
+    return str(value).lower()
+
+
+def apply_pragmas(con: Connection, pragmas: Mapping[str, Union[str, int]]) -> None:
+    for pragma, value in pragmas.items():
+        con.execute(f"PRAGMA {pragma} = {pragma_value(pragma, value)}").fetchall()
+
+
+def _is_healthy(con: Connection) -> bool:
+    try:
+        con.execute("SELECT 1").fetchone()
+    except Error:
+        return False
+    return True
+
+
+def _close(con: Connection) -> None:
+    try:
+        con.close()
+    except Error:
+        pass
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections.
+
+    Connections are created lazily by `factory`, at most `size` of them are
+    checked out at the same time, and idle connections are health checked
+    before being handed out again.
+    """
+
+    def __init__(
+        self, factory: Callable[[], Connection], size: int, timeout: float = 30
+    ):
+        if size < 1:
+            raise ValueError(f"Pool size must be at least 1, got {size}")
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._closed = False
+        self._in_use = 0
+        self._in_use_lock = threading.Lock()
+
+    @property
+    def in_use(self) -> int:
+        """Number of connections checked out."""
+        return self._in_use
+
+    def _count(self, delta: int) -> None:
+        with self._in_use_lock:
+            self._in_use += delta
+
+    def checkout(self) -> Connection:
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No connection available after {self.timeout}s")
+        try:
+            while True:
+                try:
+                    con = self._idle.get_nowait()
+                except queue.Empty:
+                    con = self.factory()
+                    break
+                if _is_healthy(con):
+                    break
+                _close(con)
+        except BaseException:
+            self._slots.release()
+            raise
+        self._count(1)
+        return con
+
+    def checkin(self, con: Connection) -> None:
+        try:
+            if self._closed:
+                _close(con)
+                return
+            try:
+                if con.in_transaction:
+                    con.rollback()
+            except Error:
+                _close(con)
+                return
+            self._idle.put(con)
+        finally:
+            self._count(-1)
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        con = self.checkout()
+        try:
+            yield con
+        finally:
+            self.checkin(con)
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                _close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+async def run_in_executor(executor: Executor, func: Callable, *args, **kwargs):
+    """Run a blocking database function without stalling the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
@@ -1,33 +1,63 @@
+import contextlib
 import datetime
+import functools
+import json
 import os
 import pathlib
 import random
+import signal
 import string
+import threading
+import time
 
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 from typing import Dict, List, Union
 
 
 import sqlite3
-from sqlite3 import connect, Connection, Row
-
-from fastapi import APIRouter, Body, Depends, FastAPI, HTTPException, status
+from sqlite3 import connect, Connection, Cursor, Row
+
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Response,
+    status,
+)
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer
-from pydantic import BaseModel
-
-from . import utils
+from pydantic import BaseModel, Field
+
+from . import (
+    cache,
+    config,
+    db,
+    metrics,
+    migrations,
+    qrcodes,
+    reports,
+    states,
+    tracing,
+    utils,
+)
+
+# Importing this module has no side effects: the database is opened and
+# migrated by the lifespan of the application built by create_app(), once per
+# process, before it serves requests.
+
+_IMPORT_START = time.perf_counter()
 
 DB_PATH = pathlib.Path(
     os.environ.get("LDTVOUCHERS_DB_PATH", "ldtvouchers.sqlite3")
 ).resolve()
 
-print(f"Using database: {DB_PATH}")
-
-app = FastAPI()
-
 api = APIRouter(prefix="/api")
 
 # Models
@@ -64,6 +94,30 @@ class Voucher(VoucherBase):
     history: List[str]
 
 
+class VoucherBulk(BaseModel):
+    count: int = Field(..., gt=0, le=100000)
+    label: str = ""
+    expiration_date: datetime.date
+    value: int
+
+
+class VoucherBulkResult(BaseModel):
+    ids: List[str]
+    seconds: float
+    vouchers_per_second: float
+
+
+class Scan(BaseModel):
+    voucherid: str
+    state: int
+    client_timestamp: Union[datetime.datetime, None] = None
+    idempotency_key: Union[str, None] = Field(None, max_length=255)
+
+
+class ScanBatch(BaseModel):
+    scans: List[Scan] = Field(..., max_items=1000)
+
+
 class UserBase(BaseModel):
     name: str
     description: str
@@ -79,6 +133,9 @@ class Message(BaseModel):
     text: str
     severity: int = 0  # TODO: use an enum
 
+    class Config:
+        frozen = True
+
 
 class Action(BaseModel):
     url: str
@@ -86,11 +143,17 @@ class Action(BaseModel):
     body: Union[dict, None]
     message: Union[Message, None]
 
+    class Config:
+        frozen = True
+
 
 class NextActions(BaseModel):
     scan: Union[Action, None]
     button: Union[Action, None]
 
+    class Config:
+        frozen = True
+
 
 class ActionResponse(BaseModel):
     user: Union[User, None]
@@ -100,173 +163,181 @@ class ActionResponse(BaseModel):
     next_actions: NextActions
 
 
-# Dependency: get_con
+class ScanResult(BaseModel):
+    voucherid: str
+    client_timestamp: Union[datetime.datetime, None]
+    idempotency_key: Union[str, None]
+    status_code: int
+    detail: Union[str, None]
+    response: Union[ActionResponse, None]
 
 
-def init_tables(con: Connection):
-    with con:
-        con.executescript(
-            """
-CREATE TABLE IF NOT EXISTS
-users (
-    id TEXT PRIMARY KEY,
-    name TEXT NOT NULL,
-    description TEXT NOT NULL,
-    ac_distribute INTEGER DEFAULT 0,
-    ac_cashin INTEGER DEFAULT 0
-);
-
-CREATE TABLE IF NOT EXISTS
-vouchers (
-    id TEXT PRIMARY KEY,
-    label TEXT NOT NULL,
-    expiration_date TEXT NOT NULL,
-    value INTEGER NOT NULL,
-    state INTEGER NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS
-history (
-    date TEXT NOT NULL,
-    userid TEXT NOT NULL,
-    voucherid TEXT NOT NULL,
-    state INTEGER NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS
-states (
-	state	INTEGER,
-	label	TEXT NOT NULL UNIQUE,
-	PRIMARY KEY(state)
-);
-
-INSERT OR REPLACE INTO states
-VALUES
-    (0,'registered'),
-    (1,'distributed'),
-    (2,'cashedin'),
-    (3,'expired'),
-    (4,'deactivated');
-
-CREATE VIEW IF NOT EXISTS
-	v_history
-AS
-SELECT
-	history.date as date,
-	users.description as user,
-	history.voucherid as voucher,
-	states.label as state
-FROM history
-LEFT OUTER JOIN users ON history.userid = users.id
-LEFT OUTER JOIN states ON history.state = states.state;
-
-CREATE VIEW IF NOT EXISTS
-    v_history_last_state
-AS
-SELECT
-	MAX(history.date) as date,
-	history.voucherid as voucherid,
-	users.description as user,
-	states.label as state
-FROM
-	history
-LEFT OUTER JOIN users ON history.userid = users.id
-LEFT OUTER JOIN states ON history.state = states.state
-GROUP BY voucherid;
-
-CREATE VIEW IF NOT EXISTS
-    v_history_last_registered
-AS
-SELECT
-	MAX(history.date) as date,
-	history.voucherid as voucherid,
-	users.description as user
-FROM
-	history
-LEFT OUTER JOIN users
-WHERE
-	history.state = 0
-	AND history.userid = users.id
-GROUP BY voucherid;
-
-CREATE VIEW IF NOT EXISTS
-    v_history_last_distributed
-AS
-SELECT
-	MAX(history.date) as date,
-	history.voucherid as voucherid,
-	users.description as user
-FROM
-	history
-LEFT OUTER JOIN users
-WHERE
-	history.state = 1
-	AND history.userid = users.id
-GROUP BY voucherid;
-
-CREATE VIEW IF NOT EXISTS
-    v_history_last_cashedin
-AS
-SELECT
-	MAX(history.date) as date,
-	history.voucherid as voucherid,
-	users.description as user
-FROM
-	history
-LEFT OUTER JOIN users
-WHERE
-	history.state = 2
-	AND history.userid = users.id
-GROUP BY voucherid;
-
-CREATE VIEW IF NOT EXISTS
-    v_report
-AS
-SELECT
-	vouchers.expiration_date as expiration_date,
-	vouchers.id as voucher_id,
-	vouchers.value as value_in_dollars,
-	v_history_last_state.state as last_state,
-	v_history_last_state.date as last_state_date,
-	v_history_last_state.user as last_state_by,
-	v_history_last_registered.date as last_registered_date,
-	v_history_last_registered.user as last_registered_by,
-	v_history_last_distributed.date as last_distributed_date,
-	v_history_last_distributed.user as last_distributed_by,
-	v_history_last_cashedin.date as last_cashedin_date,
-	v_history_last_cashedin.user as last_cashedin_by
-FROM
-	vouchers
-LEFT OUTER JOIN
-    v_history_last_state ON vouchers.id = v_history_last_state.voucherid
-LEFT OUTER JOIN
-    v_history_last_registered ON vouchers.id = v_history_last_registered.voucherid
-LEFT OUTER JOIN
-    v_history_last_distributed ON vouchers.id = v_history_last_distributed.voucherid
-LEFT OUTER JOIN
-    v_history_last_cashedin ON vouchers.id = v_history_last_cashedin.voucherid;
-"""
-        )
+class ScanBatchResult(BaseModel):
+    results: List[ScanResult]
+
+
+# Metrics, see GET /metrics
+
+metrics_registry = metrics.Registry()
+
+http_requests = metrics_registry.register(
+    metrics.Counter(
+        "ldtvouchers_http_requests_total",
+        "HTTP requests by route and status code, unmatched paths are 'other'",
+        ("method", "route", "status"),
+    )
+)
+http_request_seconds = metrics_registry.register(
+    metrics.Histogram(
+        "ldtvouchers_http_request_duration_seconds",
+        "Time to answer HTTP requests",
+        ("method", "route"),
+    )
+)
+http_request_db_seconds = metrics_registry.register(
+    metrics.Histogram(
+        "ldtvouchers_http_request_db_seconds",
+        "Time HTTP requests spent awaiting database calls, queueing included",
+        ("method", "route"),
+    )
+)
+http_request_handler_seconds = metrics_registry.register(
+    metrics.Histogram(
+        "ldtvouchers_http_request_handler_seconds",
+        "Time HTTP requests spent out of database calls",
+        ("method", "route"),
+    )
+)
+scan_seconds = metrics_registry.register(
+    metrics.Histogram(
+        "ldtvouchers_scan_duration_seconds",
+        "Time to apply a scan in its transaction, by voucher transition",
+        ("ac_distribute", "ac_cashin", "cur_state", "next_state"),
+    )
+)
+db_connections_opened = metrics_registry.register(
+    metrics.Counter(
+        "ldtvouchers_db_connections_opened_total",
+        "Database connections opened, read-write (rw) or read-only (ro)",
+        ("mode",),
+    )
+)
+db_pool_in_use = metrics_registry.register(
+    metrics.Gauge(
+        "ldtvouchers_db_pool_connections_in_use",
+        "Pooled database connections checked out",
+        lambda: pool.in_use,
+    )
+)
 
 
-def init_con(uri: str) -> Connection:
+def _observe_request(
+    scope: dict, status_code: int, seconds: float, db_seconds: float
+) -> None:
+    route = scope.get("route")
+    labels = scope["method"], route.path_format if route else "other"
+    http_requests.inc(*labels, status_code)
+    http_request_seconds.observe(seconds, *labels)
+    http_request_db_seconds.observe(db_seconds, *labels)
+    http_request_handler_seconds.observe(seconds - db_seconds, *labels)
+
+
+# Dependency: get_con
+
+
+def init_con(
+    uri: str, pragmas: dict = config.DB_PRAGMAS, read_only: bool = False
+) -> Connection:
     # TODO: check_same_thread probably unsafe
-    con = connect(uri, check_same_thread=False)
+    if read_only:
+        # The journal is the writers' business, and a read-only connection
+        # cannot switch it
+        uri = f"{pathlib.Path(uri).resolve().as_uri()}?mode=ro"
+        pragmas = {
+            pragma: value
+            for pragma, value in pragmas.items()
+            if pragma not in ("journal_mode", "synchronous")
+        }
+    factory = tracing.TracingConnection if config.SQL_TRACE else sqlite3.Connection
+    con = connect(uri, check_same_thread=False, uri=read_only, factory=factory)
+    if config.SQL_TRACE:
+        con.slow_query_seconds = config.SLOW_QUERY_SECONDS
+    db_connections_opened.inc("ro" if read_only else "rw")
     con.row_factory = Row
-    init_tables(con)
+    db.apply_pragmas(con, pragmas)
     return con
 
 
+# Latest voucher states, for config.STATE_STORE = "history"
+latest_states = states.LatestStates()
+
+
+def init_db(uri: str) -> None:
+    con = init_con(uri)
+    try:
+        old_version = migrations.schema_version(con)
+        new_version = migrations.migrate(con)
+        synced = states.use_store(con, config.STATE_STORE)
+        if config.STATE_STORE == "history":
+            latest_states.warm(con)
+    finally:
+        con.close()
+    if new_version != old_version:
+        print(f"Migrated database schema from v{old_version} to v{new_version}")
+    if config.STATE_STORE == "history":
+        print(f"Loaded the latest state of {len(latest_states)} vouchers")
+    elif synced:
+        print(f"Synchronized vouchers.state from history for {synced} vouchers")
+
+
+def new_pool(db_path: pathlib.Path) -> db.ConnectionPool:
+    # Connections are opened on first use
+    return db.ConnectionPool(
+        functools.partial(init_con, db_path),
+        size=config.DB_POOL_SIZE,
+        timeout=config.DB_POOL_TIMEOUT,
+    )
+
+
+# Replaced by the lifespan startup
+pool = new_pool(DB_PATH)
+
+
+# Blocking sqlite3 calls run on dedicated threads, one per pooled connection,
+# so that async routes never wait on the database from the event loop.
+db_executor = ThreadPoolExecutor(
+    max_workers=config.DB_POOL_SIZE, thread_name_prefix="ldtvouchers-db"
+)
+
+
+async def run_db(func: Callable, *args, **kwargs):
+    if config.SQL_TRACE:
+        func = functools.partial(tracing.traced, tracing.current(), func)
+    start = time.perf_counter()
+    try:
+        return await db.run_in_executor(db_executor, func, *args, **kwargs)
+    finally:
+        metrics.add_db_seconds(time.perf_counter() - start)
+
+
 def get_con() -> Connection:
-    con = init_con(DB_PATH)
+    try:
+        con = pool.checkout()
+    except db.PoolTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database busy"
+        )
     try:
         yield con
     finally:
-        con.close()
+        pool.checkin(con)
+
 
+# Report exports read a WAL snapshot on their own connection: they neither
+# hold a pooled connection nor block the writers while the client downloads.
+def get_read_only_con() -> Connection:
+    return init_con(DB_PATH, read_only=True)
 
-# Initialize database file
-next(get_con())
 
 # Dependency: oauth2_scheme
 
@@ -282,12 +353,33 @@ def decode_token(token):
     return {"name": "theName", "description": "theDescription", "id": "theId"}
 
 
+# Users rarely change during a campaign: resolved tokens are kept in memory.
+# Only known users are cached, and the API never edits them: after editing
+# the users table out-of-band, e.g. with a CSV import, send SIGHUP to the
+# server processes to clear it, along with the vouchers kept in memory.
+users_cache = cache.TTLCache(config.AUTH_CACHE_TTL)
+
+
+def _clear_caches(*_):
+    users_cache.clear()
+    latest_states.clear()
+
+
+async def get_cached_user(con: Connection, userid: str) -> Union[User, None]:
+    user = users_cache.get(userid)
+    if user is None:
+        user = await run_db(get_user, con, userid)
+        if user:
+            user = users_cache.set(userid, User(**user))
+    return user
+
+
 async def get_current_user(
     con: Connection = Depends(get_con), token: str = Depends(oauth2_scheme)
 ) -> User:
-    user = get_user(con, token)
+    user = await get_cached_user(con, token)
     if user:
-        return User(**user)
+        return user
 
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -296,22 +388,17 @@ async def get_current_user(
     )
 
 
-async def get_current_voucher(
-    voucherid: str, con: Connection = Depends(get_con)
-) -> Voucher:
-    voucher = get_voucher(con, voucherid)
-    if voucher:
-        return Voucher(**voucher)
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+# Vouchers: DB
 
 
-# Vouchers: DB
+def _read_voucher(con: Connection, voucherid: str) -> Union[Row, dict, None]:
+    if config.STATE_STORE == "history":
+        return latest_states.voucher(con, voucherid)
+    return con.execute("SELECT * FROM vouchers WHERE id=?", (voucherid,)).fetchone()
 
 
 def get_voucher(con: Connection, voucherid: str) -> dict:
-    cur = con.cursor()
-    cur.execute("SELECT * FROM vouchers WHERE id=?", (voucherid,))
-    voucher = cur.fetchone()
+    voucher = _read_voucher(con, voucherid)
     if not voucher:
         return
     ret = dict(**voucher)
@@ -321,36 +408,63 @@ def get_voucher(con: Connection, voucherid: str) -> dict:
     return ret
 
 
-def new_voucher_id(cur):  # TODO: type 
-    cur.execute(
-        """
-        SELECT COUNT(*) FROM vouchers
-        """
-    )
-    count, = cur.fetchone()
-    return utils.new_voucher_id_string(count+1)
+_VOUCHER_ID_ATTEMPTS = 5
 
+_INSERT_VOUCHER = """
+    INSERT INTO vouchers(id, label, expiration_date, value, state)
+    VALUES(:id, :label, :expiration_date, :value, :state)
+"""
 
-def new_voucher(con: Connection, user: User, voucher: VoucherBase) -> Voucher:
-    values = voucher.dict()
+
+def _insert_voucher(cur: Cursor, values: dict, index: int) -> str:
+    # The index makes ids unique, but vouchers imported by hand may share it:
+    # draw another random stamp on collision.
+    for attempt in range(_VOUCHER_ID_ATTEMPTS):
+        values["id"] = utils.new_voucher_id_string(index)
+        try:
+            cur.execute(_INSERT_VOUCHER, values)
+        except sqlite3.IntegrityError:
+            if attempt == _VOUCHER_ID_ATTEMPTS - 1:
+                raise
+        else:
+            return values["id"]
+
+
+def new_vouchers(con: Connection, user: User, vouchers: List[VoucherBase]) -> List[str]:
+    """Insert vouchers and their history rows in one transaction.
+
+    Returns the new voucher ids, in the order of `vouchers`.
+    """
+    rows = [voucher.dict() for voucher in vouchers]
     with con:
         cur = con.cursor()
-        values["id"] = new_voucher_id(cur)
-        cur.execute(
+        indices = utils.reserve_voucher_ids(cur, len(rows))
+        for values, index in zip(rows, indices):
+            values["id"] = utils.new_voucher_id_string(index)
+        cur.execute("SAVEPOINT new_vouchers")
+        try:
+            cur.executemany(_INSERT_VOUCHER, rows)
+        except sqlite3.IntegrityError:
+            cur.execute("ROLLBACK TO new_vouchers")
+            for values, index in zip(rows, indices):
+                _insert_voucher(cur, values, index)
+        cur.execute("RELEASE new_vouchers")
+        cur.executemany(
             """
             INSERT INTO history(date, userid, voucherid, state)
-            VALUES(DATETIME('now'), :userid, :voucherid, :state)
+            VALUES(DATETIME('now'), :userid, :id, :state)
             """,
-            {"userid": user.id, "voucherid": values["id"], "state": voucher.state},
+            ({"userid": user.id, **values} for values in rows),
         )
-        cur.execute(
-            """
-            INSERT INTO vouchers(id, label, expiration_date, value, state)
-            VALUES(:id, :label, :expiration_date, :value, :state)
-            """,
-            values,
-        )
-    return get_voucher(con, values["id"])
+    if config.STATE_STORE == "history":
+        for values in rows:
+            latest_states.set(values["id"], values["state"])
+    return [values["id"] for values in rows]
+
+
+def new_voucher(con: Connection, user: User, voucher: VoucherBase) -> Voucher:
+    (voucherid,) = new_vouchers(con, user, [voucher])
+    return get_voucher(con, voucherid)
 
 
 def get_voucher_history(con: Connection, voucherid: str) -> dict:
@@ -360,7 +474,6 @@ def get_voucher_history(con: Connection, voucherid: str) -> dict:
         SELECT history.date, users.name, history.state
         FROM history
         INNER JOIN users ON history.userid = users.id
-        INNER JOIN vouchers ON history.voucherid = vouchers.id
         WHERE history.voucherid = :voucherid
         ORDER BY
             history.date DESC,
@@ -374,26 +487,6 @@ def get_voucher_history(con: Connection, voucherid: str) -> dict:
 _HISTORY_MESSAGE = {0: "Registered by", 1: "Distributed by", 2: "Cashed-in by"}
 
 
-def _build_last_history_message(con: Connection, voucherid: str) -> Union[str, None]:
-    cur = con.cursor()
-    cur.execute(
-        """
-        SELECT history.date, users.name, vouchers.state
-        FROM history
-        INNER JOIN users ON history.userid = users.id
-        INNER JOIN vouchers ON history.voucherid = vouchers.id
-        WHERE history.voucherid = :voucherid
-        ORDER BY
-            history.date DESC,
-            history.rowid DESC
-        LIMIT 1
-        """,
-        (voucherid,),
-    )
-    data = cur.fetchone()
-    return _history_text(data) if data else None
-
-
 def _history_text(data):
     by = _HISTORY_MESSAGE[data["state"]]
     return "{by} {name} {date}".format(by=by, **data)
@@ -436,6 +529,63 @@ def patch_voucher(
         )
 
 
+def _keep_state(
+    con: Connection, user: User, voucher: Row, patch: VoucherPatch
+) -> Union[Row, None]:
+    if config.STATE_STORE == "history" and not _is_latest_state(con, voucher):
+        return None
+    return voucher
+
+
+def _change_state(
+    con: Connection, user: User, voucher: Row, patch: VoucherPatch
+) -> Union[Row, None]:
+    # Only move the voucher out of the state it was read in, so that two tills
+    # scanning the same voucher concurrently cannot both apply a transition.
+    # The caller commits.
+    if config.STATE_STORE == "history":
+        return _append_state(con, user, voucher, patch)
+    cur = con.cursor()
+    cur.execute(
+        """
+        UPDATE vouchers
+        SET state = :state
+        WHERE id = :id AND state = :cur_state
+        RETURNING *
+        """,
+        {"id": voucher["id"], "state": patch.state, "cur_state": voucher["state"]},
+    )
+    updated = cur.fetchone()
+    if updated:
+        cur.execute(
+            """
+            INSERT INTO history(date, userid, voucherid, state)
+            VALUES(DATETIME('now'), :userid, :voucherid, :state)
+            """,
+            {"userid": user.id, "voucherid": voucher["id"], "state": patch.state},
+        )
+    return updated
+
+
+def _append_state(
+    con: Connection, user: User, voucher: Row, patch: VoucherPatch
+) -> Union[dict, None]:
+    voucherid = voucher["id"]
+    if not states.append_state(con, user.id, voucherid, voucher["state"], patch.state):
+        # Changed by another process since our map was updated
+        latest_states.refresh(con, voucherid)
+        return None
+    # Ahead of the commit: a rollback must refresh the entry
+    latest_states.set(voucherid, patch.state)
+    return {**voucher, "state": patch.state}
+
+
+def _is_latest_state(con: Connection, voucher: Row) -> bool:
+    # Our map may be stale: another process may have appended to history.
+    # Appends check the state themselves, answers without one read it here.
+    return latest_states.refresh(con, voucher["id"]) == voucher["state"]
+
+
 # Users: DBs
 
 
@@ -464,271 +614,716 @@ def new_user(con: Connection, user: UserBase) -> dict:
 
 
 @api.get("/users/{userid}", response_model=User)
-async def users(userid: int, con: Connection = Depends(get_con)):
-    user = read_user(con, userid)
-    if user:
-        return user
+async def users(
+    userid: str,
+    user: User = Depends(get_current_user),
+    con: Connection = Depends(get_con),
+):
+    # User ids are bearer tokens: only admins may look them up
+    _check_admin(user)
+    found = await run_db(get_user, con, userid)
+    if found:
+        return User(**found)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
 @api.post("/users", response_model=User)
-async def users(user: UserBase, con: Connection = Depends(get_con)):
+async def users(
+    base: UserBase,
+    user: User = Depends(get_current_user),
+    con: Connection = Depends(get_con),
+):
+    _check_admin(user)
     try:
-        return create_user(con, user)
+        return User(**await run_db(new_user, con, base))
     except sqlite3.IntegrityError as err:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="User already exists"
         )
 
 
-def _noop(*_, **__):
-    pass
-
-
 _PATCH_VOUCHER_FUNCTIONS = {
     # ac_distribute, ac_cashin, cur_state, next_state
-    (True, False, 0, 0): _noop,
-    (True, False, 0, 1): patch_voucher,
-    (True, False, 1, 0): patch_voucher,
-    (True, False, 1, 1): _noop,
-    (True, False, 2, 1): _noop,
-    (False, True, 0, 2): _noop,
-    (False, True, 1, 2): patch_voucher,
-    (False, True, 2, 1): patch_voucher,
-    (False, True, 2, 2): _noop,
+    (True, False, 0, 0): _keep_state,
+    (True, False, 0, 1): _change_state,
+    (True, False, 1, 0): _change_state,
+    (True, False, 1, 1): _keep_state,
+    (True, False, 2, 1): _keep_state,
+    (False, True, 0, 2): _keep_state,
+    (False, True, 1, 2): _change_state,
+    (False, True, 2, 1): _change_state,
+    (False, True, 2, 2): _keep_state,
 }
 
 
-@api.patch("/vouchers/{voucherid}", response_model=ActionResponse)
-async def vouchers(
-    patch: VoucherPatch,
-    user: User = Depends(get_current_user),
-    voucher: Voucher = Depends(get_current_voucher),
-    con: Connection = Depends(get_con),
-):
+def scan_voucher(
+    con: Connection, user: User, voucherid: str, patch: VoucherPatch
+) -> ActionResponse:
+    """Apply a scan to a voucher and build the response to send to the till.
+
+    A scan costs one vouchers lookup, the UPDATE ... RETURNING and history
+    INSERT of the transition if there is one, and one history fetch that also
+    provides the last state message.
+    """
     try:
-        patch_voucher_func = _PATCH_VOUCHER_FUNCTIONS[
-            user.ac_distribute,
-            user.ac_cashin,
-            voucher.state,
-            patch.state,
-        ]
-        patch_voucher_func(con, user, voucher, patch)
-    except KeyError:
+        with con:
+            return _scan_voucher(con, user, voucherid, patch)
+    except BaseException:
+        _refresh_latest_states(con, [voucherid])
+        raise
+
+
+def _refresh_latest_states(con: Connection, voucherids: List[str]) -> None:
+    # After a rollback, forget the states appended by the transaction
+    if config.STATE_STORE == "history":
+        for voucherid in voucherids:
+            latest_states.refresh(con, voucherid)
+
+
+# Idempotency keys: a till retrying a scan after a timeout sends the same key,
+# and gets the response of the first attempt back instead of applying the
+# scan twice. Keys are scoped by user and forgotten after
+# config.IDEMPOTENCY_KEY_TTL seconds.
+
+
+def _idempotency_key_age() -> str:
+    return f"-{config.IDEMPOTENCY_KEY_TTL} seconds"
+
+
+def get_idempotent_response(
+    con: Connection, user: User, key: str, voucherid: str, state: int
+) -> Union[str, None]:
+    """Return the response stored for `key`, if any.
+
+    Raises a 422 if the key was sent with another scan: the till reused it,
+    and answering with the stored response would silently drop this scan.
+    """
+    row = con.execute(
+        """
+        SELECT response, voucherid, state FROM idempotency_keys
+        WHERE userid = :userid AND key = :key AND date > DATETIME('now', :age)
+        """,
+        {"userid": user.id, "key": key, "age": _idempotency_key_age()},
+    ).fetchone()
+    if row is None:
+        return None
+    response, key_voucherid, key_state = row
+    if key_voucherid is not None and (key_voucherid, key_state) != (voucherid, state):
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Not authorized to perform this action.",
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency key already used for another scan",
         )
-    updated_voucher = Voucher(**get_voucher(con, voucher.id))
-    message_builders = _MESSAGES[
-        user.ac_distribute,
-        user.ac_cashin,
-        voucher.state,
-        updated_voucher.state,
-    ]
-    message_main = message_builders["main"]
-    message_detail = message_builders["detail"](con, updated_voucher)
-    return ActionResponse(
-        user=user,
-        voucher=updated_voucher,
-        message_main=message_main,
-        message_detail=message_detail,
-        next_actions=build_next_actions(user, voucher, patch.state),
+    return response
+
+
+def _store_idempotent_response(
+    con: Connection, user: User, key: str, voucherid: str, state: int, response: str
+) -> None:
+    # Raises IntegrityError if the key is already in use
+    con.execute(
+        "DELETE FROM idempotency_keys WHERE date <= DATETIME('now', :age)",
+        {"age": _idempotency_key_age()},
+    )
+    con.execute(
+        """
+        INSERT INTO idempotency_keys(userid, key, date, response, voucherid, state)
+        VALUES(:userid, :key, DATETIME('now'), :response, :voucherid, :state)
+        """,
+        {
+            "userid": user.id,
+            "key": key,
+            "response": response,
+            "voucherid": voucherid,
+            "state": state,
+        },
     )
 
 
-@api.get("/auth/{userid}", response_model=ActionResponse)
-async def auth(userid: str, con: Connection = Depends(get_con)):
-    user = get_user(con, userid)
-    if user:
-        user = User(**user)
-        response = ActionResponse(
-            user=user,
-            next_actions=build_next_actions(user, None, None),
-        )
-        # TODO: fix the data model, this is ugly
-        response.message_main = response.next_actions.scan.message
+def scan_voucher_idempotent(
+    con: Connection, user: User, voucherid: str, patch: VoucherPatch, key: str
+) -> str:
+    """Like scan_voucher, but only apply the scan the first time `key` is seen.
+
+    Returns the JSON of the response. Retries cost a single primary key
+    lookup and no transaction.
+    """
+    response = get_idempotent_response(con, user, key, voucherid, patch.state)
+    if response is not None:
         return response
+    try:
+        with con:
+            response = _scan_voucher(con, user, voucherid, patch).json()
+            _store_idempotent_response(con, user, key, voucherid, patch.state, response)
+    except sqlite3.IntegrityError:
+        # A concurrent retry committed first: its scan stands, ours is rolled back
+        _refresh_latest_states(con, [voucherid])
+        response = get_idempotent_response(con, user, key, voucherid, patch.state)
+        if response is None:
+            raise
+    return response
 
-    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Invalid user")
 
+def scan_vouchers(con: Connection, user: User, scans: List[Scan]) -> List[ScanResult]:
+    """Apply scans queued by a till, in order and in one transaction.
 
-@api.get("/auth", response_model=ActionResponse)
-async def auth(user: User = Depends(get_current_user)):
-    response = ActionResponse(
+    A scan failing with an HTTP error, e.g. an unknown voucher, does not stop
+    the others: its result carries the error instead of a response. Scans
+    repeating the idempotency key of an earlier scan, in this batch or a
+    previous request, get its response without being applied again, or a 422
+    if the key was sent with another voucher or state. History
+    rows are dated by the server: `client_timestamp` is only echoed back,
+    tills' clocks are not trusted.
+    """
+    results = []
+    try:
+        with con:
+            # Take the write lock upfront so that key lookups and inserts agree
+            con.execute("BEGIN IMMEDIATE")
+            for scan in scans:
+                try:
+                    response = None
+                    if scan.idempotency_key is not None:
+                        response = get_idempotent_response(
+                            con, user, scan.idempotency_key, scan.voucherid, scan.state
+                        )
+                    if response is not None:
+                        response = json.loads(response)
+                    else:
+                        response = _scan_voucher(
+                            con, user, scan.voucherid, VoucherPatch(state=scan.state)
+                        )
+                        if scan.idempotency_key is not None:
+                            _store_idempotent_response(
+                                con,
+                                user,
+                                scan.idempotency_key,
+                                scan.voucherid,
+                                scan.state,
+                                response.json(),
+                            )
+                except HTTPException as err:
+                    result = {
+                        "status_code": err.status_code,
+                        "detail": err.detail,
+                        "response": None,
+                    }
+                else:
+                    result = {
+                        "status_code": status.HTTP_200_OK,
+                        "detail": None,
+                        "response": response,
+                    }
+                results.append(
+                    ScanResult.construct(
+                        voucherid=scan.voucherid,
+                        client_timestamp=scan.client_timestamp,
+                        idempotency_key=scan.idempotency_key,
+                        **result,
+                    )
+                )
+    except BaseException:
+        _refresh_latest_states(con, [scan.voucherid for scan in scans])
+        raise
+    return results
+
+
+# A voucher changing state between its read and its transition is read again,
+# a few times at most so that a till never waits on the write lock forever
+_SCAN_ATTEMPTS = 5
+
+
+def _scan_voucher(
+    con: Connection, user: User, voucherid: str, patch: VoucherPatch
+) -> ActionResponse:
+    start = time.perf_counter()
+    for _ in range(_SCAN_ATTEMPTS):
+        voucher = _read_voucher(con, voucherid)
+        if not voucher:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Not found"
+            )
+        try:
+            transition = _TRANSITIONS[
+                user.ac_distribute,
+                user.ac_cashin,
+                voucher["state"],
+                patch.state,
+            ]
+        except KeyError:
+            if config.STATE_STORE == "history" and not _is_latest_state(con, voucher):
+                continue
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Not authorized to perform this action.",
+            )
+        # None when the voucher changed state since it was read: start over
+        updated = transition.patch_voucher(con, user, voucher, patch)
+        if updated:
+            break
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The voucher keeps changing state, scan it again.",
+        )
+
+    history = get_voucher_history(con, voucherid)
+    updated_voucher = Voucher(
+        history=[_history_text(data) for data in history], **updated
+    )
+    response = ActionResponse.construct(
         user=user,
-        next_actions=build_next_actions(user, None, None),
+        voucher=updated_voucher,
+        message_main=transition.message_main,
+        message_detail=transition.message_detail(history),
+        next_actions=_with_voucher(transition.next_actions, voucherid),
+    )
+    scan_seconds.observe(
+        time.perf_counter() - start,
+        int(user.ac_distribute),
+        int(user.ac_cashin),
+        voucher["state"],
+        patch.state,
     )
-    # TODO: fix the data model, this is ugly
-    response.message_main = response.next_actions.scan.message
     return response
 
 
-@dataclass
-class Builder:
-    scan: Callable
-    button: Callable
+def _json_response(response: BaseModel) -> Response:
+    # Responses are assembled from validated parts: skip FastAPI's validation
+    return Response(content=response.json(), media_type="application/json")
 
 
-def _build_scan_to_distribute_action() -> Action:
-    return Action(
-        url="/api/vouchers/{code}",
-        verb="PATCH",
-        body={"state": 1},  # distributed
-        message=Message(text="Scan to distribute a voucher"),
+@api.patch("/vouchers/{voucherid}", response_model=ActionResponse)
+async def vouchers(
+    voucherid: str,
+    patch: VoucherPatch,
+    idempotency_key: Union[str, None] = Header(None, max_length=255),
+    user: User = Depends(get_current_user),
+    con: Connection = Depends(get_con),
+):
+    if idempotency_key is None:
+        return _json_response(await run_db(scan_voucher, con, user, voucherid, patch))
+    response = await run_db(
+        scan_voucher_idempotent, con, user, voucherid, patch, idempotency_key
     )
+    return Response(content=response, media_type="application/json")
 
 
-def _build_scan_to_cashin_action() -> Action:
-    return Action(
-        url="/api/vouchers/{code}",
-        verb="PATCH",
-        body={"state": 2},  # cashedin
-        message=Message(text="Scan to cash a voucher in"),
-    )
+@api.post("/scans", response_model=ScanBatchResult)
+async def scans(
+    batch: ScanBatch,
+    user: User = Depends(get_current_user),
+    con: Connection = Depends(get_con),
+):
+    results = await run_db(scan_vouchers, con, user, batch.scans)
+    return _json_response(ScanBatchResult.construct(results=results))
 
 
-def _build_distribute_action(voucher: Voucher) -> Action:
-    return Action(
-        url=f"/api/vouchers/{voucher.id}",
-        verb="PATCH",
-        body={"state": 1},  # cashedin
-        message=Message(text="Distribute", severity=1),
+@api.post("/vouchers:bulk", response_model=VoucherBulkResult)
+async def vouchers(
+    bulk: VoucherBulk,
+    user: User = Depends(get_current_user),
+    con: Connection = Depends(get_con),
+):
+    _check_admin(user)
+    voucher = VoucherBase(state=0, **bulk.dict(exclude={"count"}))  # registered
+    start = time.perf_counter()
+    ids = await run_db(new_vouchers, con, user, [voucher] * bulk.count)
+    seconds = time.perf_counter() - start
+    return VoucherBulkResult(
+        ids=ids, seconds=seconds, vouchers_per_second=len(ids) / seconds
     )
 
 
-def _build_cancel_distribute_action(voucher: Voucher) -> Action:
-    return Action(
-        url=f"/api/vouchers/{voucher.id}",
-        verb="PATCH",
-        body={"state": 0},  # cashedin
-        message=Message(text="Cancel distribution", severity=2),
-    )
+def _check_admin(user: User) -> None:
+    if not (user.ac_distribute and user.ac_cashin):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authorized to perform this action.",
+        )
 
 
-def _build_cancel_cashin_action(voucher: Voucher) -> Action:
-    return Action(
-        url=f"/api/vouchers/{voucher.id}",
-        verb="PATCH",
-        body={"state": 1},  # distributed
-        message=Message(text="Cancel cashing-in", severity=2),
+# Reports
+
+
+@api.get("/reports/{name}.{fmt}")
+async def report(
+    name: str,
+    fmt: str,
+    since: Union[datetime.date, None] = None,
+    until: Union[datetime.date, None] = None,
+    state: Union[str, None] = None,
+    token: str = Depends(oauth2_scheme),
+    con: Connection = Depends(get_read_only_con),
+):
+    try:
+        if name not in reports.EXPORTS or fmt not in reports.FORMATS:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Unknown report"
+            )
+        user = await get_cached_user(con, token)
+        if not user:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Not authenticated",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        _check_admin(user)
+        cur = await run_db(reports.select, con, name, since, until, state)
+    except BaseException:
+        con.close()
+        raise
+    return StreamingResponse(
+        _stream_report(con, cur, fmt),
+        media_type=reports.FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
     )
 
 
-def _build_cashin_action(voucher: Voucher) -> Action:
-    return Action(
-        url=f"/api/vouchers/{voucher.id}",
-        verb="PATCH",
-        body={"state": 2},  # distributed
-        message=Message(text="Cash-in", severity=1),
+async def _stream_report(con: Connection, cur: Cursor, fmt: str):
+    try:
+        columns = reports.columns(cur)
+        yield reports.format_header(fmt, columns)
+        while True:
+            rows = await run_db(cur.fetchmany, config.REPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield reports.format_rows(fmt, columns, rows)
+    finally:
+        con.close()
+
+
+# QR codes
+
+
+@api.get("/vouchers/{voucherid}/qrcode.{fmt}")
+async def qrcode(
+    voucherid: str,
+    fmt: str,
+    if_none_match: Union[str, None] = Header(None),
+    user: User = Depends(get_current_user),
+    con: Connection = Depends(get_con),
+):
+    if fmt not in qrcodes.FORMATS or not await run_db(_read_voucher, con, voucherid):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    etag = qrcodes.etag(voucherid, fmt)
+    # A voucher's code never changes, but only its users may see it
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400"}
+    if if_none_match is not None and _etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(
+        content=qrcodes.render(voucherid, fmt),
+        media_type=qrcodes.FORMATS[fmt],
+        headers=headers,
     )
 
 
-def _build_none(*_, **__) -> None:
-    return None
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    # Weak comparison, W/ prefixes do not matter
+    tags = {tag[2:] if tag.startswith("W/") else tag for tag in tags}
+    return "*" in tags or etag in tags
 
 
-_BUILDERS = {  # (ac_distribute, ac_cashin, cur_state, next_state)
-    (True, False, None, None): Builder(
-        scan=_build_scan_to_distribute_action, button=_build_none
-    ),
-    (True, False, 0, 1): Builder(
-        scan=_build_scan_to_distribute_action, button=_build_cancel_distribute_action
-    ),
-    (True, False, 1, 0): Builder(
-        scan=_build_scan_to_distribute_action, button=_build_distribute_action
+@api.get("/auth/{userid}", response_model=ActionResponse)
+async def auth(userid: str, con: Connection = Depends(get_con)):
+    user = await get_cached_user(con, userid)
+    if user:
+        return _json_response(_auth_response(user))
+
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Invalid user")
+
+
+@api.get("/auth", response_model=ActionResponse)
+async def auth(user: User = Depends(get_current_user)):
+    return _json_response(_auth_response(user))
+
+
+def _auth_response(user: User) -> ActionResponse:
+    next_actions = build_next_actions(user, None, None, None)
+    return ActionResponse.construct(
+        user=user,
+        # TODO: fix the data model, this is ugly
+        message_main=next_actions.scan.message,
+        next_actions=next_actions,
+    )
+
+
+# Response fragments: voucher specific urls are formatted with the voucher id
+
+_SCAN_TO_DISTRIBUTE_ACTION = Action(
+    url="/api/vouchers/{code}",
+    verb="PATCH",
+    body={"state": 1},  # distributed
+    message=Message(text="Scan to distribute a voucher"),
+)
+
+_SCAN_TO_CASHIN_ACTION = Action(
+    url="/api/vouchers/{code}",
+    verb="PATCH",
+    body={"state": 2},  # cashedin
+    message=Message(text="Scan to cash a voucher in"),
+)
+
+_DISTRIBUTE_ACTION = Action(
+    url="/api/vouchers/{voucherid}",
+    verb="PATCH",
+    body={"state": 1},  # distributed
+    message=Message(text="Distribute", severity=1),
+)
+
+_CANCEL_DISTRIBUTE_ACTION = Action(
+    url="/api/vouchers/{voucherid}",
+    verb="PATCH",
+    body={"state": 0},  # registered
+    message=Message(text="Cancel distribution", severity=2),
+)
+
+_CANCEL_CASHIN_ACTION = Action(
+    url="/api/vouchers/{voucherid}",
+    verb="PATCH",
+    body={"state": 1},  # distributed
+    message=Message(text="Cancel cashing-in", severity=2),
+)
+
+_CASHIN_ACTION = Action(
+    url="/api/vouchers/{voucherid}",
+    verb="PATCH",
+    body={"state": 2},  # cashedin
+    message=Message(text="Cash-in", severity=1),
+)
+
+_NEXT_ACTIONS = {  # (ac_distribute, ac_cashin, cur_state, next_state)
+    (True, False, None, None): NextActions(scan=_SCAN_TO_DISTRIBUTE_ACTION),
+    (True, False, 0, 0): NextActions(
+        scan=_SCAN_TO_DISTRIBUTE_ACTION, button=_DISTRIBUTE_ACTION
     ),
-    (True, False, 1, 1): Builder(
-        scan=_build_scan_to_distribute_action, button=_build_cancel_distribute_action
+    (True, False, 0, 1): NextActions(
+        scan=_SCAN_TO_DISTRIBUTE_ACTION, button=_CANCEL_DISTRIBUTE_ACTION
     ),
-    (True, False, 2, 1): Builder(
-        scan=_build_scan_to_distribute_action, button=_build_none
+    (True, False, 1, 0): NextActions(
+        scan=_SCAN_TO_DISTRIBUTE_ACTION, button=_DISTRIBUTE_ACTION
     ),
-    (False, True, None, None): Builder(
-        scan=_build_scan_to_cashin_action, button=_build_none
+    (True, False, 1, 1): NextActions(
+        scan=_SCAN_TO_DISTRIBUTE_ACTION, button=_CANCEL_DISTRIBUTE_ACTION
     ),
-    (False, True, 0, 2): Builder(scan=_build_scan_to_cashin_action, button=_build_none),
-    (False, True, 1, 2): Builder(
-        scan=_build_scan_to_cashin_action, button=_build_cancel_cashin_action
+    (True, False, 2, 1): NextActions(scan=_SCAN_TO_DISTRIBUTE_ACTION),
+    (False, True, None, None): NextActions(scan=_SCAN_TO_CASHIN_ACTION),
+    (False, True, 0, 2): NextActions(scan=_SCAN_TO_CASHIN_ACTION),
+    (False, True, 1, 2): NextActions(
+        scan=_SCAN_TO_CASHIN_ACTION, button=_CANCEL_CASHIN_ACTION
     ),
-    (False, True, 2, 1): Builder(
-        scan=_build_scan_to_cashin_action, button=_build_cashin_action
+    (False, True, 2, 1): NextActions(
+        scan=_SCAN_TO_CASHIN_ACTION, button=_CASHIN_ACTION
     ),
-    (False, True, 2, 2): Builder(
-        scan=_build_scan_to_cashin_action, button=_build_cancel_cashin_action
+    (False, True, 2, 2): NextActions(
+        scan=_SCAN_TO_CASHIN_ACTION, button=_CANCEL_CASHIN_ACTION
     ),
 }
 
 
-def _last_state_message(con: Connection, voucher: Voucher) -> Message:
-    return Message(text=_build_last_history_message(con, voucher.id), severity=0)
+def _no_message(history: List[Row]) -> None:
+    return None
+
+
+def _last_state_message(history: List[Row]) -> Union[Message, None]:
+    if history:
+        return Message(text=_history_text(history[0]), severity=0)
 
 
-_MESSAGES = {
+_MESSAGES = {  # (ac_distribute, ac_cashin, cur_state, new_state)
+    (True, False, 0, 0): {
+        "main": Message(text="Not yet distributed", severity=2),
+        "detail": _no_message,
+    },
     (True, False, 0, 1): {
-        "main": {"text": "Distributed", "severity": 1},
-        "detail": _build_none,
+        "main": Message(text="Distributed", severity=1),
+        "detail": _no_message,
     },
     (True, False, 1, 0): {
-        "main": {"text": "Distribution cancelled", "severity": 2},
-        "detail": _build_none,
+        "main": Message(text="Distribution cancelled", severity=2),
+        "detail": _no_message,
     },
     (True, False, 1, 1): {
-        "main": {"text": "Already distributed", "severity": 2},
+        "main": Message(text="Already distributed", severity=2),
         "detail": _last_state_message,
     },
     (True, False, 2, 2): {
-        "main": {"text": "Already spent", "severity": 2},
+        "main": Message(text="Already spent", severity=2),
         "detail": _last_state_message,
     },
     (False, True, 0, 0): {
-        "main": {"text": "Not yet distributed", "severity": 2},
-        "detail": _build_none,
+        "main": Message(text="Not yet distributed", severity=2),
+        "detail": _no_message,
     },
     (False, True, 1, 2): {
-        "main": {"text": "Cashed-in", "severity": 1},
-        "detail": _build_none,
+        "main": Message(text="Cashed-in", severity=1),
+        "detail": _no_message,
     },
     (False, True, 2, 1): {
-        "main": {"text": "Cashed-in cancelled", "severity": 2},
-        "detail": _build_none,
+        "main": Message(text="Cashed-in cancelled", severity=2),
+        "detail": _no_message,
     },
     (False, True, 2, 2): {
-        "main": {"text": "Already cashed-in", "severity": 2},
+        "main": Message(text="Already cashed-in", severity=2),
         "detail": _last_state_message,
     },
 }
 
 
+@dataclass(frozen=True)
+class Transition:
+    patch_voucher: Callable
+    message_main: Message
+    message_detail: Callable
+    next_actions: NextActions
+
+
+def _compile_transitions() -> Dict[tuple, Transition]:
+    transitions = {}
+    for key, patch_voucher_func in _PATCH_VOUCHER_FUNCTIONS.items():
+        ac_distribute, ac_cashin, cur_state, next_state = key
+        new_state = next_state if patch_voucher_func is _change_state else cur_state
+        try:
+            messages = _MESSAGES[ac_distribute, ac_cashin, cur_state, new_state]
+            next_actions = _NEXT_ACTIONS[key]
+        except KeyError:
+            raise RuntimeError(f"No response defined for voucher transition {key}")
+        transitions[key] = Transition(
+            patch_voucher=patch_voucher_func,
+            message_main=messages["main"],
+            message_detail=messages["detail"],
+            next_actions=next_actions,
+        )
+    return transitions
+
+
+# Checks at import time that every allowed transition has a response
+_TRANSITIONS = _compile_transitions()
+
+
+def _with_voucher(next_actions: NextActions, voucherid: str) -> NextActions:
+    button = next_actions.button
+    if button is None:
+        return next_actions
+    button = button.copy(update={"url": button.url.format(voucherid=voucherid)})
+    return next_actions.copy(update={"button": button})
+
+
 def build_next_actions(
-    user: User, voucher: Union[Voucher, None], next_state: Union[int, None]
+    user: User,
+    voucher: Union[Voucher, None],
+    cur_state: Union[int, None],
+    next_state: Union[int, None],
 ) -> NextActions:
-    cur_state = voucher.state if voucher else None
-    builders = _BUILDERS[(user.ac_distribute, user.ac_cashin, cur_state, next_state)]
-    return NextActions(scan=builders.scan(), button=builders.button(voucher))
+    next_actions = _NEXT_ACTIONS[
+        user.ac_distribute, user.ac_cashin, cur_state, next_state
+    ]
+    return _with_voucher(next_actions, voucher.id) if voucher else next_actions
 
 
 # Start
 
 
+_START_RESPONSE = ActionResponse(
+    message_main=Message(text="Not authentified", severity=2),
+    message_detail=Message(text="Scan an authentification barcode", severity=0),
+    next_actions=NextActions(scan=Action(url="/api/auth/{code}", verb="GET")),
+).json()
+
+
 @api.get("/start", response_model=ActionResponse)
 async def start():
-    return ActionResponse(
-        message_main=Message(text="Not authentified", severity=2),
-        message_detail=Message(text="Scan an authentification barcode", severity=0),
-        next_actions=NextActions(scan=Action(url="/api/auth/{code}", verb="GET")),
-    )
+    return Response(content=_START_RESPONSE, media_type="application/json")
 
 
-app.include_router(api)
+async def get_metrics():
+    return Response(content=metrics_registry.render(), media_type=metrics.CONTENT_TYPE)
 
-# Static
 
-if os.environ.get("LDTVOUCHERS_SERVE_STATIC_FILES", True):
-    path = pathlib.Path(__file__).with_name("static")
-    print(f"Serving static files: {path}")
-    app.mount(
-        "/",
-        StaticFiles(directory=path, html=True, check_dir=True),
-        name="static",
+# Application
+
+_startup_seconds = None
+
+startup_duration = metrics_registry.register(
+    metrics.Gauge(
+        "ldtvouchers_startup_seconds",
+        "Time from importing the application to serving requests",
+        lambda: _startup_seconds or 0,
     )
+)
+
+
+def startup(db_path: pathlib.Path) -> None:
+    """Initialize the database, connection pool and caches of the process."""
+    global DB_PATH, pool
+    print(f"Using database: {db_path}")
+    DB_PATH = db_path
+    pool = new_pool(db_path)
+    users_cache.clear()
+    init_db(db_path)
+    if (
+        hasattr(signal, "SIGHUP")
+        and threading.current_thread() is threading.main_thread()
+    ):
+        signal.signal(signal.SIGHUP, _clear_caches)
+
+
+def shutdown() -> None:
+    pool.close()
+    latest_states.clear()
+
+
+def create_app(
+    db_path: Union[str, pathlib.Path, None] = None,
+    serve_static_files: Union[bool, None] = None,
+) -> FastAPI:
+    """Build the application, the database at `db_path`, by default
+    LDTVOUCHERS_DB_PATH, being opened at startup."""
+    db_path = DB_PATH if db_path is None else pathlib.Path(db_path).resolve()
+    if serve_static_files is None:
+        serve_static_files = bool(
+            os.environ.get("LDTVOUCHERS_SERVE_STATIC_FILES", True)
+        )
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI):
+        global _startup_seconds
+        start = time.perf_counter()
+        startup(db_path)
+        now = time.perf_counter()
+        # The import time only counts for the first application of the process
+        _startup_seconds = now - (start if _startup_seconds else _IMPORT_START)
+        print(
+            f"Started in {_startup_seconds * 1000:.0f} ms, "
+            f"{(now - start) * 1000:.0f} ms initializing the database"
+        )
+        if _startup_seconds > config.STARTUP_BUDGET_SECONDS:
+            print(
+                f"Warning: startup exceeded its budget of "
+                f"{config.STARTUP_BUDGET_SECONDS * 1000:.0f} ms"
+            )
+        try:
+            yield
+        finally:
+            shutdown()
+
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(metrics.MetricsMiddleware, observe=_observe_request)
+    app.add_middleware(tracing.TracingMiddleware, enabled=lambda: config.SQL_TRACE)
+    app.include_router(api)
+    app.add_api_route("/metrics", get_metrics, include_in_schema=False)
+
+    # Static
+
+    if serve_static_files:
+        path = pathlib.Path(__file__).with_name("static")
+        app.mount(
+            "/",
+            StaticFiles(directory=path, html=True, check_dir=True),
+            name="static",
+        )
+    return app
+
+
+# For `uvicorn app.main:app`, or `uvicorn --factory app.main:create_app`
+app = create_app()
@@ -0,0 +1,221 @@
+import bisect
+import threading
+import time
+
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Counters, gauges and histograms exposed in the Prometheus text format by
+# GET /metrics. Metrics are updated from the event loop and from the database
+# threads, each one behind its own lock.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Prometheus client defaults, in seconds
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _check_labels(self, labels: tuple) -> None:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {', '.join(self.labelnames)}, "
+                f"got {labels!r}"
+            )
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {_escape(self.documentation)}"
+        yield f"# TYPE {self.name} {self.type}"
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._check_labels(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def collect(self) -> Iterator[str]:
+        yield from super().collect()
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield (
+                f"{self.name}{_format_labels(self.labelnames, labels)} "
+                f"{_format_value(value)}"
+            )
+
+
+class Gauge(_Metric):
+    """A value read from `function` at each collection."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def collect(self) -> Iterator[str]:
+        yield from super().collect()
+        yield f"{self.name} {_format_value(self.function())}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels: (count per bucket, the last one for +Inf, sum)
+        self._values: Dict[tuple, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        self._check_labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(labels) or (
+                [0] * (len(self.buckets) + 1),
+                0.0,
+            )
+            counts[index] += 1
+            self._values[labels] = counts, total + value
+
+    def count(self, *labels) -> int:
+        counts, _ = self._values.get(labels, ([], 0.0))
+        return sum(counts)
+
+    def collect(self) -> Iterator[str]:
+        yield from super().collect()
+        with self._lock:
+            values = sorted(
+                (labels, (list(counts), total))
+                for labels, (counts, total) in self._values.items()
+            )
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket"
+                    f"{_format_labels(names, labels + (_format_value(bound),))} "
+                    f"{cumulative}"
+                )
+            formatted = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{formatted} {_format_value(total)}"
+            yield f"{self.name}_count{formatted} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(
+            line + "\n" for metric in self._metrics for line in metric.collect()
+        )
+
+
+# Seconds the current request spent awaiting database calls, None outside of
+# a request
+_db_seconds: ContextVar = ContextVar("db_seconds", default=None)
+
+
+def add_db_seconds(seconds: float) -> None:
+    spent = _db_seconds.get()
+    if spent is not None:
+        spent[0] += seconds
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing HTTP requests.
+
+    Once a request is answered, `observe(scope, status_code, seconds,
+    db_seconds)` is called. The scope then holds the matched route, if any.
+    """
+
+    def __init__(self, app, observe: Callable):
+        self.app = app
+        self.observe = observe
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        spent = [0.0]
+        token = _db_seconds.set(spent)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _db_seconds.reset(token)
+            self.observe(scope, status_code, time.perf_counter() - start, spent[0])
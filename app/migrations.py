@@ -0,0 +1,597 @@
+import sqlite3
+
+from sqlite3 import Connection
+from typing import Iterator
+
+# Each migration is a SQL script bringing the schema from version N (its index
+# in the list) to version N + 1. The version is stored in PRAGMA user_version.
+# Migrations are append-only: never edit one that has been released.
+
+MIGRATIONS = [
+    # 1: initial schema, idempotent for databases created before migrations
+    """
+CREATE TABLE IF NOT EXISTS
+users (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    ac_distribute INTEGER DEFAULT 0,
+    ac_cashin INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS
+vouchers (
+    id TEXT PRIMARY KEY,
+    label TEXT NOT NULL,
+    expiration_date TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    state INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS
+history (
+    date TEXT NOT NULL,
+    userid TEXT NOT NULL,
+    voucherid TEXT NOT NULL,
+    state INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS
+states (
+	state	INTEGER,
+	label	TEXT NOT NULL UNIQUE,
+	PRIMARY KEY(state)
+);
+
+INSERT OR REPLACE INTO states
+VALUES
+    (0,'registered'),
+    (1,'distributed'),
+    (2,'cashedin'),
+    (3,'expired'),
+    (4,'deactivated');
+
+CREATE VIEW IF NOT EXISTS
+	v_history
+AS
+SELECT
+	history.date as date,
+	users.description as user,
+	history.voucherid as voucher,
+	states.label as state
+FROM history
+LEFT OUTER JOIN users ON history.userid = users.id
+LEFT OUTER JOIN states ON history.state = states.state;
+
+CREATE VIEW IF NOT EXISTS
+    v_history_last_state
+AS
+SELECT
+	MAX(history.date) as date,
+	history.voucherid as voucherid,
+	users.description as user,
+	states.label as state
+FROM
+	history
+LEFT OUTER JOIN users ON history.userid = users.id
+LEFT OUTER JOIN states ON history.state = states.state
+GROUP BY voucherid;
+
+CREATE VIEW IF NOT EXISTS
+    v_history_last_registered
+AS
+SELECT
+	MAX(history.date) as date,
+	history.voucherid as voucherid,
+	users.description as user
+FROM
+	history
+LEFT OUTER JOIN users
+WHERE
+	history.state = 0
+	AND history.userid = users.id
+GROUP BY voucherid;
+
+CREATE VIEW IF NOT EXISTS
+    v_history_last_distributed
+AS
+SELECT
+	MAX(history.date) as date,
+	history.voucherid as voucherid,
+	users.description as user
+FROM
+	history
+LEFT OUTER JOIN users
+WHERE
+	history.state = 1
+	AND history.userid = users.id
+GROUP BY voucherid;
+
+CREATE VIEW IF NOT EXISTS
+    v_history_last_cashedin
+AS
+SELECT
+	MAX(history.date) as date,
+	history.voucherid as voucherid,
+	users.description as user
+FROM
+	history
+LEFT OUTER JOIN users
+WHERE
+	history.state = 2
+	AND history.userid = users.id
+GROUP BY voucherid;
+
+CREATE VIEW IF NOT EXISTS
+    v_report
+AS
+SELECT
+	vouchers.expiration_date as expiration_date,
+	vouchers.id as voucher_id,
+	vouchers.value as value_in_dollars,
+	v_history_last_state.state as last_state,
+	v_history_last_state.date as last_state_date,
+	v_history_last_state.user as last_state_by,
+	v_history_last_registered.date as last_registered_date,
+	v_history_last_registered.user as last_registered_by,
+	v_history_last_distributed.date as last_distributed_date,
+	v_history_last_distributed.user as last_distributed_by,
+	v_history_last_cashedin.date as last_cashedin_date,
+	v_history_last_cashedin.user as last_cashedin_by
+FROM
+	vouchers
+LEFT OUTER JOIN
+    v_history_last_state ON vouchers.id = v_history_last_state.voucherid
+LEFT OUTER JOIN
+    v_history_last_registered ON vouchers.id = v_history_last_registered.voucherid
+LEFT OUTER JOIN
+    v_history_last_distributed ON vouchers.id = v_history_last_distributed.voucherid
+LEFT OUTER JOIN
+    v_history_last_cashedin ON vouchers.id = v_history_last_cashedin.voucherid;
+""",
+    # 2: index the history table, join users explicitly in the last_* views
+    """
+CREATE INDEX IF NOT EXISTS
+    history_voucherid_date
+ON history(voucherid, date);
+
+CREATE INDEX IF NOT EXISTS
+    history_state_voucherid_date
+ON history(state, voucherid, date);
+
+DROP VIEW v_history_last_registered;
+
+CREATE VIEW
+    v_history_last_registered
+AS
+SELECT
+	MAX(history.date) as date,
+	history.voucherid as voucherid,
+	users.description as user
+FROM
+	history
+INNER JOIN users ON history.userid = users.id
+WHERE
+	history.state = 0
+GROUP BY voucherid;
+
+DROP VIEW v_history_last_distributed;
+
+CREATE VIEW
+    v_history_last_distributed
+AS
+SELECT
+	MAX(history.date) as date,
+	history.voucherid as voucherid,
+	users.description as user
+FROM
+	history
+INNER JOIN users ON history.userid = users.id
+WHERE
+	history.state = 1
+GROUP BY voucherid;
+
+DROP VIEW v_history_last_cashedin;
+
+CREATE VIEW
+    v_history_last_cashedin
+AS
+SELECT
+	MAX(history.date) as date,
+	history.voucherid as voucherid,
+	users.description as user
+FROM
+	history
+INNER JOIN users ON history.userid = users.id
+WHERE
+	history.state = 2
+GROUP BY voucherid;
+""",
+    # 3: sequences to allocate voucher ids, starting after the existing ones
+    """
+CREATE TABLE IF NOT EXISTS
+sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO sequences(name, value)
+SELECT
+    'vouchers',
+    MAX(
+        COUNT(*),
+        COALESCE(MAX(CAST(substr(id, 1, instr(id, '-') - 1) AS INTEGER)), 0)
+    )
+FROM vouchers;
+""",
+    # 4: voucher_report, the v_report rows maintained by triggers. The last_*
+    # views now break date ties by insertion order, like the triggers do.
+    """
+DROP VIEW v_history_last_state;
+
+CREATE VIEW
+    v_history_last_state
+AS
+SELECT date, voucherid, user, state
+FROM (
+    SELECT
+        history.date as date,
+        history.voucherid as voucherid,
+        users.description as user,
+        states.label as state,
+        ROW_NUMBER() OVER (
+            PARTITION BY history.voucherid
+            ORDER BY history.date DESC, history.rowid DESC
+        ) as rank
+    FROM
+        history
+    LEFT OUTER JOIN users ON history.userid = users.id
+    LEFT OUTER JOIN states ON history.state = states.state
+)
+WHERE rank = 1;
+
+DROP VIEW v_history_last_registered;
+
+CREATE VIEW
+    v_history_last_registered
+AS
+SELECT date, voucherid, user
+FROM (
+    SELECT
+        history.date as date,
+        history.voucherid as voucherid,
+        users.description as user,
+        ROW_NUMBER() OVER (
+            PARTITION BY history.voucherid
+            ORDER BY history.date DESC, history.rowid DESC
+        ) as rank
+    FROM
+        history
+    INNER JOIN users ON history.userid = users.id
+    WHERE
+        history.state = 0
+)
+WHERE rank = 1;
+
+DROP VIEW v_history_last_distributed;
+
+CREATE VIEW
+    v_history_last_distributed
+AS
+SELECT date, voucherid, user
+FROM (
+    SELECT
+        history.date as date,
+        history.voucherid as voucherid,
+        users.description as user,
+        ROW_NUMBER() OVER (
+            PARTITION BY history.voucherid
+            ORDER BY history.date DESC, history.rowid DESC
+        ) as rank
+    FROM
+        history
+    INNER JOIN users ON history.userid = users.id
+    WHERE
+        history.state = 1
+)
+WHERE rank = 1;
+
+DROP VIEW v_history_last_cashedin;
+
+CREATE VIEW
+    v_history_last_cashedin
+AS
+SELECT date, voucherid, user
+FROM (
+    SELECT
+        history.date as date,
+        history.voucherid as voucherid,
+        users.description as user,
+        ROW_NUMBER() OVER (
+            PARTITION BY history.voucherid
+            ORDER BY history.date DESC, history.rowid DESC
+        ) as rank
+    FROM
+        history
+    INNER JOIN users ON history.userid = users.id
+    WHERE
+        history.state = 2
+)
+WHERE rank = 1;
+
+CREATE TABLE IF NOT EXISTS
+voucher_report (
+    expiration_date TEXT,
+    voucher_id TEXT PRIMARY KEY,
+    value_in_dollars INTEGER,
+    last_state TEXT,
+    last_state_date TEXT,
+    last_state_by TEXT,
+    last_registered_date TEXT,
+    last_registered_by TEXT,
+    last_distributed_date TEXT,
+    last_distributed_by TEXT,
+    last_cashedin_date TEXT,
+    last_cashedin_by TEXT
+);
+
+INSERT INTO voucher_report SELECT * FROM v_report;
+
+CREATE TRIGGER IF NOT EXISTS
+    voucher_report_insert_voucher
+AFTER INSERT ON vouchers
+BEGIN
+    INSERT INTO voucher_report(expiration_date, voucher_id, value_in_dollars)
+    VALUES (NEW.expiration_date, NEW.id, NEW.value)
+    ON CONFLICT(voucher_id) DO UPDATE SET
+        expiration_date = excluded.expiration_date,
+        value_in_dollars = excluded.value_in_dollars;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+    voucher_report_update_voucher
+AFTER UPDATE OF id, expiration_date, value ON vouchers
+BEGIN
+    UPDATE voucher_report
+    SET
+        voucher_id = NEW.id,
+        expiration_date = NEW.expiration_date,
+        value_in_dollars = NEW.value
+    WHERE voucher_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+    voucher_report_delete_voucher
+AFTER DELETE ON vouchers
+BEGIN
+    DELETE FROM voucher_report WHERE voucher_id = OLD.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS
+    voucher_report_insert_history
+AFTER INSERT ON history
+BEGIN
+    INSERT INTO voucher_report(voucher_id)
+    VALUES (NEW.voucherid)
+    ON CONFLICT(voucher_id) DO NOTHING;
+
+    UPDATE voucher_report
+    SET
+        last_state = (SELECT label FROM states WHERE state = NEW.state),
+        last_state_date = NEW.date,
+        last_state_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND (last_state_date IS NULL OR last_state_date <= NEW.date);
+
+    UPDATE voucher_report
+    SET
+        last_registered_date = NEW.date,
+        last_registered_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND NEW.state = 0
+        AND EXISTS (SELECT 1 FROM users WHERE id = NEW.userid)
+        AND (last_registered_date IS NULL OR last_registered_date <= NEW.date);
+
+    UPDATE voucher_report
+    SET
+        last_distributed_date = NEW.date,
+        last_distributed_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND NEW.state = 1
+        AND EXISTS (SELECT 1 FROM users WHERE id = NEW.userid)
+        AND (last_distributed_date IS NULL OR last_distributed_date <= NEW.date);
+
+    UPDATE voucher_report
+    SET
+        last_cashedin_date = NEW.date,
+        last_cashedin_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND NEW.state = 2
+        AND EXISTS (SELECT 1 FROM users WHERE id = NEW.userid)
+        AND (last_cashedin_date IS NULL OR last_cashedin_date <= NEW.date);
+END;
+""",
+    # 5: stable history ids for the incremental report exports. VACUUM may
+    # renumber implicit rowids, and AUTOINCREMENT never reuses an id.
+    # Dropping history drops its indexes and triggers: recreate them.
+    """
+CREATE TABLE
+history_new (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date TEXT NOT NULL,
+    userid TEXT NOT NULL,
+    voucherid TEXT NOT NULL,
+    state INTEGER NOT NULL
+);
+
+INSERT INTO history_new(id, date, userid, voucherid, state)
+SELECT rowid, date, userid, voucherid, state FROM history ORDER BY rowid;
+
+DROP TABLE history;
+
+-- Keep the views referencing history as they are
+PRAGMA legacy_alter_table = ON;
+
+ALTER TABLE history_new RENAME TO history;
+
+PRAGMA legacy_alter_table = OFF;
+
+CREATE INDEX
+    history_voucherid_date
+ON history(voucherid, date);
+
+CREATE INDEX
+    history_state_voucherid_date
+ON history(state, voucherid, date);
+
+CREATE TRIGGER
+    voucher_report_insert_history
+AFTER INSERT ON history
+BEGIN
+    INSERT INTO voucher_report(voucher_id)
+    VALUES (NEW.voucherid)
+    ON CONFLICT(voucher_id) DO NOTHING;
+
+    UPDATE voucher_report
+    SET
+        last_state = (SELECT label FROM states WHERE state = NEW.state),
+        last_state_date = NEW.date,
+        last_state_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND (last_state_date IS NULL OR last_state_date <= NEW.date);
+
+    UPDATE voucher_report
+    SET
+        last_registered_date = NEW.date,
+        last_registered_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND NEW.state = 0
+        AND EXISTS (SELECT 1 FROM users WHERE id = NEW.userid)
+        AND (last_registered_date IS NULL OR last_registered_date <= NEW.date);
+
+    UPDATE voucher_report
+    SET
+        last_distributed_date = NEW.date,
+        last_distributed_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND NEW.state = 1
+        AND EXISTS (SELECT 1 FROM users WHERE id = NEW.userid)
+        AND (last_distributed_date IS NULL OR last_distributed_date <= NEW.date);
+
+    UPDATE voucher_report
+    SET
+        last_cashedin_date = NEW.date,
+        last_cashedin_by = (SELECT description FROM users WHERE id = NEW.userid)
+    WHERE
+        voucher_id = NEW.voucherid
+        AND NEW.state = 2
+        AND EXISTS (SELECT 1 FROM users WHERE id = NEW.userid)
+        AND (last_cashedin_date IS NULL OR last_cashedin_date <= NEW.date);
+END;
+
+CREATE TABLE
+report_exports (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    full INTEGER NOT NULL,
+    since_history_id INTEGER NOT NULL,
+    last_history_id INTEGER NOT NULL,
+    report_rows INTEGER NOT NULL,
+    history_rows INTEGER NOT NULL
+);
+""",
+    # 6: responses to the recent scans sent with an Idempotency-Key
+    """
+CREATE TABLE
+idempotency_keys (
+    userid TEXT NOT NULL,
+    key TEXT NOT NULL,
+    date TEXT NOT NULL,
+    response TEXT NOT NULL,
+    PRIMARY KEY (userid, key)
+) WITHOUT ROWID;
+
+CREATE INDEX
+    idempotency_keys_date
+ON idempotency_keys(date);
+""",
+    # 7: latest state of a voucher in one index seek, for the history store,
+    # and the store the database was last opened with
+    """
+CREATE INDEX
+    history_voucherid_id_state
+ON history(voucherid, id, state);
+
+CREATE TABLE
+settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+INSERT INTO settings VALUES ('state_store', 'column');
+""",
+    # 8: printables stream the vouchers by campaign, in insertion order
+    """
+CREATE INDEX
+    vouchers_label
+ON vouchers(label);
+""",
+    # 9: the scan each idempotency key was sent with, NULL for the keys stored
+    # before, so that a key reused for another scan is rejected
+    """
+ALTER TABLE idempotency_keys ADD COLUMN voucherid TEXT;
+
+ALTER TABLE idempotency_keys ADD COLUMN state INTEGER;
+""",
+    # 10: report exports only count once delivered, the earlier ones were
+    """
+ALTER TABLE report_exports ADD COLUMN committed INTEGER NOT NULL DEFAULT 1;
+""",
+]
+
+
+def _statements(script: str) -> Iterator[str]:
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+    if statement.strip():
+        raise ValueError(f"Incomplete SQL statement: {statement.strip()}")
+
+
+def schema_version(con: Connection) -> int:
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(con: Connection, migrations: list = MIGRATIONS) -> int:
+    """Apply the pending migrations and return the new schema version.
+
+    The whole upgrade runs in a single immediate transaction, so concurrent
+    processes starting on the same database apply each migration only once.
+    """
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        version = schema_version(con)
+        if version > len(migrations):
+            raise RuntimeError(
+                f"Database schema version {version} is newer than this "
+                f"application ({len(migrations)})"
+            )
+        for version, script in enumerate(migrations[version:], start=version + 1):
+            for statement in _statements(script):
+                con.execute(statement)
+            con.execute(f"PRAGMA user_version = {version:d}")
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    return version
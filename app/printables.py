@@ -0,0 +1,421 @@
+import functools
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+import re
+import string
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Dict, Iterable, Iterator, List, Set, Tuple, Union
+
+import jinja2
+import jinja2.meta
+
+from sqlite3 import Connection, Cursor
+
+from . import qrcodes, states
+
+# Printables are sheets of vouchers, VOUCHERS_PER_PAGE per page, and one page
+# per user with their authentification code. Their SVG templates live in
+# templates/printables and are rendered either by the ninja build written by
+# bin/generate_printable.py, or in-process by render().
+#
+# Both are incremental: the ninja build files are only rewritten when their
+# content changes, so ninja's timestamps stay valid, and render() caches each
+# page's PDF under the digest of everything it is rendered from.
+#
+# Templates without variables, e.g. the verso of the vouchers, render the same
+# page for every sheet: it is built once and shared by all the sheets.
+
+VOUCHERS_PER_PAGE = 6
+
+# Stands in for the QR code of the missing vouchers of the last sheet
+EMPTY_QRCODE = "empty.svg"
+
+# Output sizes in pixels at 300 dpi, (width, height)
+LANDSCAPE = (3508, 2480)
+PORTRAIT = (2480, 3508)
+
+
+def select_vouchers(
+    con: Connection,
+    label: Union[str, None] = None,
+    expiration_date: Union[str, None] = None,
+    state: Union[str, None] = None,
+    after: Union[str, None] = None,
+) -> Cursor:
+    """Return a cursor over the vouchers to print, by campaign then in
+    insertion order.
+
+    The order follows the vouchers_label index, so the rows stream without a
+    sort, and vouchers added to a campaign only change its last sheets.
+    `state` is a state label, e.g. "registered", and `after` resumes after the
+    given voucher. With the history store, whose scans leave vouchers.state
+    as emitted, `state` is matched against the last history row.
+    """
+    clauses = ["TRUE"]
+    if label is not None:
+        clauses.append("label = :label")
+    if expiration_date is not None:
+        clauses.append("expiration_date = :expiration_date")
+    if state is not None:
+        current = "state"
+        if states.recorded_store(con) == "history":
+            # One seek in history_voucherid_id_state per voucher
+            current = """COALESCE(
+                (
+                    SELECT history.state FROM history
+                    WHERE history.voucherid = vouchers.id
+                    ORDER BY history.id DESC
+                    LIMIT 1
+                ),
+                vouchers.state
+            )"""
+        clauses.append(f"{current} = (SELECT state FROM states WHERE label = :state)")
+    if after is not None:
+        clauses.append(
+            "(label, rowid) > (SELECT label, rowid FROM vouchers WHERE id = :after)"
+        )
+    return con.execute(
+        f"""
+        SELECT * FROM vouchers INDEXED BY vouchers_label
+        WHERE {' AND '.join(clauses)}
+        ORDER BY label, rowid
+        """,
+        {
+            "label": label,
+            "expiration_date": expiration_date,
+            "state": state,
+            "after": after,
+        },
+    )
+
+
+def select_users(con: Connection) -> Cursor:
+    return con.execute("SELECT * FROM users ORDER BY id")
+
+
+def group(iterator: Iterable, count: int) -> Iterator[tuple]:
+    group = []
+    for item in iterator:
+        group.append(item)
+        if len(group) == count:
+            yield tuple(group)
+            group.clear()
+
+    if group:
+        yield tuple(group)
+
+
+def build_voucher_template_dict(prefix: str, row: dict) -> dict:
+    if not row:
+        return {
+            f"{prefix}v": "",
+            f"{prefix}l": "",
+            f"{prefix}i": "",
+            f"{prefix}c": EMPTY_QRCODE,
+        }
+
+    return {
+        f"{prefix}v": f"{row['value']}$",
+        f"{prefix}l": row["label"],
+        f"{prefix}i": row["id"],
+        f"{prefix}c": row["qrcode"],
+    }
+
+
+@dataclass
+class Sheet:
+    """The data of a vouchers sheet or of a user page."""
+
+    root: pathlib.Path  # working directory of the page
+    items: List[dict]  # vouchers or user rows, with their qrcode file name
+    data: dict  # template context
+
+
+def voucher_sheets(rows: Iterable, date_now: str) -> Iterator[Sheet]:
+    prefixes = string.ascii_lowercase[:VOUCHERS_PER_PAGE]
+    for page_rows in group(rows, VOUCHERS_PER_PAGE):
+        first, last = page_rows[0], page_rows[-1]
+        root = pathlib.Path(
+            f"tmp/vouchers/{first['label']}-{last['label']}-{first['id']}-{last['id']}"
+        )
+        vouchers = [
+            dict(date_now=date_now, qrcode=f"qrcode-{row['id']}.svg", **row)
+            for row in page_rows
+        ]
+        data = {}
+        for prefix, row in itertools.zip_longest(prefixes, vouchers):
+            data.update(build_voucher_template_dict(prefix, row))
+        yield Sheet(root, vouchers, data)
+
+
+def user_sheets(rows: Iterable, date_now: str) -> Iterator[Sheet]:
+    for row in rows:
+        user = dict(date_now=date_now, qrcode="qrcode.svg", **row)
+        yield Sheet(pathlib.Path(f"tmp/users/{user['id']}"), [user], user)
+
+
+# In-process rendering
+
+
+def write_if_changed(path: pathlib.Path, content: Union[str, bytes]) -> bool:
+    """Write `content` to `path` unless it already holds it, leaving its
+    modification time alone. Returns whether the file was written."""
+    if isinstance(content, str):
+        content = content.encode()
+    try:
+        if path.read_bytes() == content:
+            return False
+    except FileNotFoundError:
+        pass
+    path.write_bytes(content)
+    return True
+
+
+def dump_json(data: dict) -> str:
+    return json.dumps(data, sort_keys=True, indent=4)
+
+
+@dataclass
+class Page:
+    template: str  # path relative to the templates directory
+    context: dict
+    size: Tuple[int, int]
+    qrcodes: Dict[str, str] = field(default_factory=dict)  # context key: content
+
+
+def voucher_pages(sheet: Sheet) -> List[Page]:
+    codes = {
+        f"{prefix}c": voucher["id"]
+        for prefix, voucher in zip(string.ascii_lowercase, sheet.items)
+    }
+    return [
+        Page(
+            "vouchers/recto.svg",
+            sheet.data,
+            LANDSCAPE,
+            codes,
+        ),
+        Page("vouchers/verso.svg", sheet.data, LANDSCAPE),
+    ]
+
+
+def user_pages(sheet: Sheet) -> List[Page]:
+    (user,) = sheet.items
+    return [
+        Page(
+            "users/page.svg",
+            sheet.data,
+            PORTRAIT,
+            {"qrcode": user["id"]},
+        )
+    ]
+
+
+def environment(templates_dir: pathlib.Path) -> jinja2.Environment:
+    # Same settings as bin/render_jinja_template.py
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(templates_dir),
+        autoescape=jinja2.select_autoescape(["html", "xml"]),
+    )
+
+
+def template_variables(env: jinja2.Environment, template: str) -> Set[str]:
+    source, *_ = env.loader.get_source(env, template)
+    return jinja2.meta.find_undeclared_variables(env.parse(source))
+
+
+@functools.lru_cache(maxsize=None)
+def is_static(env: jinja2.Environment, template: str) -> bool:
+    """Whether the template renders the same page whatever its context."""
+    return not template_variables(env, template)
+
+
+_HREF = re.compile(r'xlink:href="([^"]+)"')
+
+
+def template_assets(env: jinja2.Environment, template: str) -> List[str]:
+    """The files next to the template it links to, e.g. its background."""
+    source, filename, _ = env.loader.get_source(env, template)
+    directory = pathlib.Path(filename).parent
+    return sorted(
+        {
+            href
+            for href in _HREF.findall(source)
+            if "{" not in href and (directory / href).is_file()
+        }
+    )
+
+
+def shared(env: jinja2.Environment, page: Page) -> Page:
+    """Drop the context of a page whose template does not use it, so that
+    the page has the same digest for every sheet."""
+    if is_static(env, page.template):
+        return replace(page, context={}, qrcodes={})
+    return page
+
+
+def render_svg(env: jinja2.Environment, page: Page) -> str:
+    context = dict(page.context)
+    for key, content in page.qrcodes.items():
+        context[key] = qrcodes.data_uri(content)
+    return env.get_template(page.template).render(**context)
+
+
+@functools.lru_cache(maxsize=None)
+def _directory_digest(directory: pathlib.Path) -> str:
+    # The template and the assets it links to, which live next to it
+    digest = hashlib.sha256()
+    for path in sorted(directory.iterdir()):
+        if path.is_file():
+            digest.update(path.name.encode())
+            digest.update(hashlib.sha256(path.read_bytes()).digest())
+    return digest.hexdigest()
+
+
+def page_digest(page: Page, templates_dir: pathlib.Path) -> str:
+    """Digest of everything a page is rendered from: its context, QR codes
+    and size, and the files of its template directory."""
+    inputs = {
+        "template": page.template,
+        "files": _directory_digest((templates_dir / page.template).parent),
+        "context": page.context,
+        "qrcodes": page.qrcodes,
+        "size": page.size,
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+# Worker processes compile each template once, in their own environment
+_templates_dir = None
+_env = None
+
+
+def _init_worker(templates_dir: pathlib.Path) -> None:
+    global _templates_dir, _env
+    _templates_dir = templates_dir
+    _env = environment(templates_dir)
+
+
+def _render_pdf(page: Page, output: pathlib.Path) -> pathlib.Path:
+    # Imported in the workers only: writing the ninja build does not need cairo
+    import cairosvg
+
+    width, height = page.size
+    # Written aside then renamed, so an interrupted run leaves no partial PDF
+    # in the cache
+    partial = output.with_suffix(f".{os.getpid()}.tmp")
+    cairosvg.svg2pdf(
+        bytestring=render_svg(_env, page).encode(),
+        # Resolves the relative links to the images next to the template
+        url=str(_templates_dir / page.template),
+        write_to=str(partial),
+        unsafe=True,
+        dpi=300,
+        output_width=width,
+        output_height=height,
+    )
+    partial.replace(output)
+    return output
+
+
+def render(
+    pages: Iterable[Page],
+    templates_dir: pathlib.Path,
+    cache_dir: pathlib.Path,
+    jobs: int = None,
+    progress=sys.stderr,
+) -> List[pathlib.Path]:
+    """Render pages to PDF in a pool of `jobs` processes, returning the PDF
+    paths in the order of `pages`.
+
+    Each PDF is stored in `cache_dir` under the digest of the page, and
+    pages already there are not rendered again. At most a few pages per
+    process are queued at once, so `pages` can be a lazy iterator.
+    """
+    jobs = jobs or os.cpu_count()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    env = environment(templates_dir)
+    paths = []
+    cached = 0
+    # Pages sharing a digest, e.g. static ones, are rendered once: the next
+    # ones wait for the same result, then find it in the cache
+    rendering = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        jobs, initializer=_init_worker, initargs=(templates_dir,)
+    ) as executor:
+        pending = []
+        for page in itertools.chain(pages, [None]):
+            if page is not None:
+                page = shared(env, page)
+                digest = page_digest(page, templates_dir)
+                output = cache_dir / f"{digest}.pdf"
+                if digest in rendering:
+                    result = rendering[digest]
+                elif output.exists():
+                    result = output
+                    cached += 1
+                else:
+                    result = executor.submit(_render_pdf, page, output)
+                    rendering[digest] = result
+                pending.append((digest, result))
+            while pending and (page is None or len(pending) >= 4 * jobs):
+                digest, result = pending.pop(0)
+                if not isinstance(result, pathlib.Path):
+                    result = result.result()
+                    rendering.pop(digest, None)
+                paths.append(result)
+                if progress:
+                    seconds = time.perf_counter() - start
+                    print(
+                        f"\r{len(paths)} pages ({cached} cached), "
+                        f"{len(paths) / seconds:.1f} pages/s",
+                        end="",
+                        file=progress,
+                    )
+    if progress and paths:
+        print(file=progress)
+    return paths
+
+
+def prune(cache_dir: pathlib.Path, keep: Iterable[pathlib.Path]) -> int:
+    """Remove the cached PDFs not in `keep`, returning how many were
+    removed."""
+    keep = set(keep)
+    removed = 0
+    for path in cache_dir.glob("*.pdf"):
+        if path not in keep:
+            path.unlink()
+            removed += 1
+    return removed
+
+
+def unite(paths: List[pathlib.Path], output: pathlib.Path) -> None:
+    """Join the page PDFs into one, in which the objects they have in common,
+    e.g. the background images, are stored once and shared by the pages."""
+    # Imported here only: writing the ninja build does not need pypdf
+    import pypdf
+
+    writer = pypdf.PdfWriter()
+    # Pages added again from the same reader, e.g. the static verso, reuse
+    # the objects already copied
+    readers = {}
+    for path in paths:
+        if path not in readers:
+            readers[path] = pypdf.PdfReader(path)
+        for page in readers[path].pages:
+            writer.add_page(page)
+    # The pages of different files embed identical copies of the same images:
+    # by default, duplicates are merged and the unreferenced copies dropped
+    writer.compress_identical_objects()
+    with open(output, "wb") as fp:
+        writer.write(fp)
@@ -0,0 +1,36 @@
+import base64
+import functools
+import hashlib
+import io
+
+import segno
+
+from . import config
+
+# QR codes of voucher and user ids, for the printables and the API. They are
+# made like `qrencode -t SVG`: error correction level L, 4 modules of margin.
+# A code only depends on its content, so the rendered bytes are kept in an LRU
+# cache and their ETag never changes.
+
+FORMATS = {"svg": "image/svg+xml", "png": "image/png"}
+
+# Pixels per module of the PNG codes, SVG codes scale freely
+PNG_SCALE = 10
+
+
+@functools.lru_cache(maxsize=config.QRCODE_CACHE_SIZE)
+def render(content: str, fmt: str = "svg") -> bytes:
+    buffer = io.BytesIO()
+    options = {"scale": PNG_SCALE} if fmt == "png" else {}
+    segno.make_qr(content, error="l").save(buffer, kind=fmt, border=4, **options)
+    return buffer.getvalue()
+
+
+@functools.lru_cache(maxsize=config.QRCODE_CACHE_SIZE)
+def etag(content: str, fmt: str = "svg") -> str:
+    return f'"{hashlib.sha256(render(content, fmt)).hexdigest()[:32]}"'
+
+
+def data_uri(content: str) -> str:
+    """The SVG code as a data URI, to embed in a template."""
+    return f"data:{FORMATS['svg']};base64,{base64.b64encode(render(content)).decode()}"
@@ -0,0 +1,221 @@
+import csv
+import datetime
+import io
+import json
+
+from sqlite3 import Connection, Cursor, Row
+from typing import List, Sequence, TextIO, Union
+
+# voucher_report holds the rows of the v_report view, maintained by triggers
+# on vouchers and history. Deleting or editing history rows, or renaming
+# users, is not tracked: rebuild the report afterwards.
+
+
+def rebuild(con: Connection) -> int:
+    """Recompute voucher_report from v_report, returning its number of rows."""
+    with con:
+        con.execute("DELETE FROM voucher_report")
+        cur = con.execute("INSERT INTO voucher_report SELECT * FROM v_report")
+    return cur.rowcount
+
+
+def check(con: Connection) -> List[Row]:
+    """Return the rows where voucher_report and v_report differ.
+
+    Each row is prefixed with a `problem` column: `missing` for a v_report row
+    absent from voucher_report, `unexpected` for the other way around.
+    """
+    # Without MATERIALIZED the planner inlines v_report and reevaluates its
+    # window subqueries for every voucher
+    cur = con.execute("""
+        WITH
+            expected AS MATERIALIZED (SELECT * FROM v_report),
+            actual AS MATERIALIZED (SELECT * FROM voucher_report)
+        SELECT 'missing' as problem, * FROM (
+            SELECT * FROM expected
+            EXCEPT
+            SELECT * FROM actual
+        )
+        UNION ALL
+        SELECT 'unexpected' as problem, * FROM (
+            SELECT * FROM actual
+            EXCEPT
+            SELECT * FROM expected
+        )
+        ORDER BY voucher_id, problem
+        """)
+    return cur.fetchall()
+
+
+# Exports: name -> (relation, date column, state column)
+EXPORTS = {
+    "report": ("voucher_report", "last_state_date", "last_state"),
+    "history": ("v_history", "date", "state"),
+}
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def select(
+    con: Connection,
+    name: str,
+    since: Union[datetime.date, None] = None,
+    until: Union[datetime.date, None] = None,
+    state: Union[str, None] = None,
+) -> Cursor:
+    """Return a cursor over the rows of the `name` export.
+
+    `since` and `until` are inclusive days. Rows are left in table order so
+    that no sort materializes the export before its first row.
+    """
+    relation, date_column, state_column = EXPORTS[name]
+    clauses = ["TRUE"]
+    if since is not None:
+        clauses.append(f"{date_column} >= :since")
+    if until is not None:
+        clauses.append(f"{date_column} < DATE(:until, '+1 day')")
+    if state is not None:
+        clauses.append(f"{state_column} = :state")
+    return con.execute(
+        f"SELECT * FROM {relation} WHERE {' AND '.join(clauses)}",
+        {"since": since, "until": until, "state": state},
+    )
+
+
+def columns(cur: Cursor) -> List[str]:
+    return [description[0] for description in cur.description]
+
+
+def format_header(fmt: str, columns: Sequence[str]) -> str:
+    return format_rows(fmt, columns, [columns]) if fmt == "csv" else ""
+
+
+def format_rows(fmt: str, columns: Sequence[str], rows: Sequence[Sequence]) -> str:
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, dialect="excel").writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in rows)
+
+
+# Incremental exports: report_exports records the history ids covered by each
+# run. A run exports the history rows after the previous committed run's last
+# id, and the report rows of the vouchers they touch. Vouchers edited without
+# a history row, e.g. by hand, only show up in full exports. A run recorded
+# with commit=False is only taken into account once committed, e.g. after
+# its CSVs were mailed.
+
+# v_history, ordered and filtered by history id
+_HISTORY_SINCE = """
+    SELECT
+        history.date as date,
+        users.description as user,
+        history.voucherid as voucher,
+        states.label as state
+    FROM history
+    LEFT OUTER JOIN users ON history.userid = users.id
+    LEFT OUTER JOIN states ON history.state = states.state
+    WHERE history.id > :since AND history.id <= :last
+    ORDER BY history.id
+"""
+
+_REPORT_SINCE = """
+    SELECT * FROM voucher_report
+    WHERE voucher_id IN (
+        SELECT voucherid FROM history WHERE id > :since AND id <= :last
+    )
+    ORDER BY voucher_id
+"""
+
+_REPORT_FULL = "SELECT * FROM voucher_report ORDER BY voucher_id"
+
+
+def full_export_due(con: Connection, days: float) -> bool:
+    """Whether no full export was made in the last `days` days."""
+    (date,) = con.execute(
+        "SELECT MAX(date) FROM report_exports WHERE full AND committed"
+    ).fetchone()
+    if date is None:
+        return True
+    (due,) = con.execute(
+        "SELECT :date <= DATETIME('now', :age)", {"date": date, "age": f"-{days} days"}
+    ).fetchone()
+    return bool(due)
+
+
+def _write_csv(cur: Cursor, f: TextIO, fetch_size: int) -> int:
+    f.write(format_header("csv", columns(cur)))
+    count = 0
+    while True:
+        rows = cur.fetchmany(fetch_size)
+        if not rows:
+            return count
+        f.write(format_rows("csv", None, rows))
+        count += len(rows)
+
+
+def export(
+    con: Connection,
+    report: TextIO,
+    history: TextIO,
+    full: bool = False,
+    fetch_size: int = 500,
+    commit: bool = True,
+) -> Row:
+    """Write the report and history CSVs since the previous export.
+
+    With `full`, write the whole report and history instead. Returns the
+    report_exports row recording the run: the next export starts after its
+    `last_history_id`, once it is committed, with `commit` or commit_export().
+    """
+    # One read transaction: both CSVs come from the same snapshot, and rows
+    # inserted while exporting are left to the next run
+    con.execute("BEGIN")
+    try:
+        (previous,) = con.execute("""
+            SELECT COALESCE(MAX(last_history_id), 0) FROM report_exports
+            WHERE committed
+            """).fetchone()
+        (last,) = con.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()
+        bounds = {"since": 0 if full else previous, "last": last}
+
+        history_rows = _write_csv(
+            con.execute(_HISTORY_SINCE, bounds), history, fetch_size
+        )
+        cur = con.execute(_REPORT_FULL) if full else con.execute(_REPORT_SINCE, bounds)
+        report_rows = _write_csv(cur, report, fetch_size)
+    finally:
+        con.rollback()
+
+    with con:
+        cur = con.execute(
+            """
+            INSERT INTO report_exports(
+                date, full, since_history_id, last_history_id,
+                report_rows, history_rows, committed
+            )
+            VALUES (
+                DATETIME('now'), :full, :since, :last, :report, :history, :commit
+            )
+            RETURNING *
+            """,
+            {
+                **bounds,
+                "full": full,
+                "report": report_rows,
+                "history": history_rows,
+                "commit": commit,
+            },
+        )
+        return cur.fetchone()
+
+
+def commit_export(con: Connection, exportid: int) -> bool:
+    """Commit an export recorded with commit=False, returning False if there
+    is no such export."""
+    with con:
+        cur = con.execute(
+            "UPDATE report_exports SET committed = TRUE WHERE id = :id",
+            {"id": exportid},
+        )
+    return cur.rowcount == 1
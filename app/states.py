@@ -0,0 +1,177 @@
+from sqlite3 import Connection
+from typing import Dict, Union
+
+# With config.STATE_STORE = "history", the history table is the only record of
+# voucher states: the state of a voucher is the one of its last history row,
+# in insertion order, or vouchers.state if it has none, and vouchers.state is
+# left untouched. A scan is a single
+# conditional append, and each process keeps the latest states in memory.
+#
+# The map is a cache: another process appending to history makes it stale.
+# append_state detects it since it checks the state in the database, scans
+# answered without appending, or refused, read the latest state first: one
+# index seek, the price of running several workers. The voucher rows are
+# cached along with their states, so a scan applying a transition reads
+# nothing from the database.
+
+
+# The state of a voucher: the one of its last history row, or vouchers.state
+# for the vouchers without history, e.g. imported with `sqlite3 .import`.
+# history_voucherid_id_state covers the first query: one index seek.
+_LATEST_STATE = """
+    COALESCE(
+        (
+            SELECT state FROM history
+            WHERE voucherid = :voucherid
+            ORDER BY id DESC
+            LIMIT 1
+        ),
+        (SELECT state FROM vouchers WHERE id = :voucherid)
+    )
+"""
+
+
+def latest_state(con: Connection, voucherid: str) -> Union[int, None]:
+    """Return the state of a voucher, None for an unknown voucher."""
+    (state,) = con.execute(
+        f"SELECT {_LATEST_STATE}", {"voucherid": voucherid}
+    ).fetchone()
+    return state
+
+
+def append_state(
+    con: Connection, userid: str, voucherid: str, cur_state: int, state: int
+) -> bool:
+    """Append a history row moving a voucher from `cur_state` to `state`.
+
+    Returns False, appending nothing, if the voucher is no longer in
+    `cur_state`. The caller commits.
+    """
+    cur = con.execute(
+        f"""
+        INSERT INTO history(date, userid, voucherid, state)
+        SELECT DATETIME('now'), :userid, :voucherid, :state
+        WHERE {_LATEST_STATE} = :cur_state
+        """,
+        {
+            "userid": userid,
+            "voucherid": voucherid,
+            "state": state,
+            "cur_state": cur_state,
+        },
+    )
+    return cur.rowcount == 1
+
+
+def recorded_store(con: Connection) -> str:
+    """The state store the database was last used with."""
+    (store,) = con.execute(
+        "SELECT value FROM settings WHERE name = 'state_store'"
+    ).fetchone()
+    return store
+
+
+def use_store(con: Connection, store: str) -> int:
+    """Record the state store the database is used with.
+
+    Leaving the history store, whose scans do not update vouchers.state,
+    copies the latest history states to vouchers.state. Returns the number of
+    vouchers updated.
+    """
+    with con:
+        if recorded_store(con) == store:
+            return 0
+        con.execute(
+            "UPDATE settings SET value = :store WHERE name = 'state_store'",
+            {"store": store},
+        )
+        if store == "column":
+            return sync_voucher_states(con)
+    return 0
+
+
+def sync_voucher_states(con: Connection) -> int:
+    """Copy the latest history states to vouchers.state, returning the number
+    of vouchers updated."""
+    with con:
+        cur = con.execute("""
+            UPDATE vouchers
+            SET state = latest.state
+            FROM (
+                SELECT voucherid, state
+                FROM (
+                    SELECT
+                        voucherid,
+                        state,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY voucherid ORDER BY id DESC
+                        ) AS rank
+                    FROM history
+                )
+                WHERE rank = 1
+            ) AS latest
+            WHERE vouchers.id = latest.voucherid AND vouchers.state != latest.state
+            """)
+    return cur.rowcount
+
+
+class LatestStates:
+    """In-memory map of the latest state of each voucher."""
+
+    def __init__(self):
+        self._states: Dict[str, int] = {}
+        # The other columns of the vouchers read by this process: they do not
+        # change once emitted
+        self._rows: Dict[str, dict] = {}
+
+    def warm(self, con: Connection) -> int:
+        """Load the latest states from history, returning the number of
+        vouchers."""
+        states = {}
+        # Later rows overwrite earlier ones
+        for voucherid, state in con.execute(
+            "SELECT voucherid, state FROM history ORDER BY id"
+        ):
+            states[voucherid] = state
+        self._states = states
+        return len(states)
+
+    def get(self, con: Connection, voucherid: str) -> Union[int, None]:
+        """Return the latest state of a voucher, reading it from the database
+        on a miss, e.g. for vouchers emitted by another process."""
+        state = self._states.get(voucherid)
+        if state is None:
+            state = self.refresh(con, voucherid)
+        return state
+
+    def voucher(self, con: Connection, voucherid: str) -> Union[dict, None]:
+        """Return a voucher with its latest state, reading its row from the
+        database on the first call only."""
+        row = self._rows.get(voucherid)
+        if row is None:
+            row = con.execute(
+                "SELECT * FROM vouchers WHERE id = :voucherid",
+                {"voucherid": voucherid},
+            ).fetchone()
+            if row is None:
+                return None
+            row = self._rows[voucherid] = dict(row)
+        return {**row, "state": self.get(con, voucherid)}
+
+    def set(self, voucherid: str, state: int) -> None:
+        self._states[voucherid] = state
+
+    def refresh(self, con: Connection, voucherid: str) -> Union[int, None]:
+        state = latest_state(con, voucherid)
+        if state is None:
+            self._states.pop(voucherid, None)
+        else:
+            self._states[voucherid] = state
+        return state
+
+    def clear(self) -> None:
+        self._states = {}
+        self._rows = {}
+
+    def __len__(self) -> int:
+        return len(self._states)
@@ -0,0 +1,251 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, List, Union
+
+# Opt-in SQL tracing, enabled by config.SQL_TRACE. Connections created with
+# factory=TracingConnection time every statement, from its execution to its
+# last fetch, and count its rows. Statements run on behalf of a request are
+# recorded in its Trace, summed up in the Server-Timing header of the
+# response, and statements slower than config.SLOW_QUERY_SECONDS are logged
+# with their query plan.
+#
+# Cursors see the statements they run, BEGIN included, but not the COMMIT of
+# `with con:`: the trace callback records the statements run out of a cursor,
+# each one lasting until the next event of the thread.
+
+logger = logging.getLogger("ldtvouchers.sql")
+
+
+@dataclass
+class Statement:
+    sql: str
+    seconds: float = 0.0
+    rows: int = 0
+    logged: bool = field(default=False, repr=False)
+
+
+class Trace:
+    """The statements run for one request."""
+
+    def __init__(self):
+        self.statements: List[Statement] = []
+
+    @property
+    def seconds(self) -> float:
+        return sum(statement.seconds for statement in self.statements)
+
+    @property
+    def rows(self) -> int:
+        return sum(statement.rows for statement in self.statements)
+
+    def server_timing(self, slowest: int = 3) -> str:
+        """The Server-Timing header value: the total, then the slowest
+        statements."""
+        metrics = [
+            f'sql;dur={self.seconds * 1000:.2f};desc="{len(self.statements)} '
+            f'statements, {self.rows} rows"'
+        ]
+        statements = sorted(self.statements, key=lambda s: s.seconds, reverse=True)
+        for index, statement in enumerate(statements[:slowest], start=1):
+            metrics.append(
+                f"sql-{index};dur={statement.seconds * 1000:.2f};"
+                f'desc="{_summary(statement.sql)}"'
+            )
+        return ", ".join(metrics)
+
+
+def _summary(sql: str, length: int = 60) -> str:
+    summary = " ".join(sql.split()).replace('"', "'").replace("\\", "")
+    return summary if len(summary) <= length else summary[: length - 3] + "..."
+
+
+# The trace of the request being handled, in the event loop
+_request_trace: ContextVar = ContextVar("request_trace", default=None)
+
+# Per database thread: the trace of the call being run, whether a cursor is
+# running a statement, and the statement seen by the trace callback, with its
+# start time, until the next event
+_local = threading.local()
+
+
+def current() -> Union[Trace, None]:
+    return _request_trace.get()
+
+
+def traced(trace: Union[Trace, None], func: Callable, *args, **kwargs):
+    """Call `func`, recording its statements in `trace`."""
+    _local.trace = trace
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _close_callback_statement()
+        _local.trace = None
+
+
+def _record(sql: str) -> Statement:
+    statement = Statement(sql)
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.statements.append(statement)
+    return statement
+
+
+def _close_callback_statement() -> None:
+    opened = getattr(_local, "opened", None)
+    if opened is not None:
+        _local.opened = None
+        con, statement, start = opened
+        _add_time(con, statement, start, None)
+
+
+def _add_time(con, statement: Statement, start: float, parameters) -> None:
+    statement.seconds += time.perf_counter() - start
+    if statement.seconds >= con.slow_query_seconds and not statement.logged:
+        statement.logged = True
+        logger.warning(
+            "Slow query, %.1f ms, %d rows: %s\n%s",
+            statement.seconds * 1000,
+            statement.rows,
+            statement.sql.strip(),
+            con.query_plan(statement.sql, parameters),
+        )
+
+
+class TracingCursor(sqlite3.Cursor):
+    def _run(
+        self, method: Callable, sql: str, parameters, plan_parameters
+    ) -> "TracingCursor":
+        _close_callback_statement()
+        self._statement = statement = _record(sql)
+        self._plan_parameters = plan_parameters
+        _local.busy = True
+        start = time.perf_counter()
+        try:
+            method(sql, parameters)
+        finally:
+            _local.busy = False
+            if self.description is None:
+                statement.rows = max(self.rowcount, 0)
+            _add_time(self.connection, statement, start, plan_parameters)
+        return self
+
+    def execute(self, sql: str, parameters=()) -> "TracingCursor":
+        return self._run(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters) -> "TracingCursor":
+        # The parameters may be a generator: no query plan for these
+        return self._run(super().executemany, sql, seq_of_parameters, None)
+
+    def _fetch(self, method: Callable, *args):
+        statement = getattr(self, "_statement", None)
+        if statement is None:
+            return method(*args)
+        _close_callback_statement()
+        start = time.perf_counter()
+        _local.busy = True
+        try:
+            result = method(*args)
+        finally:
+            _local.busy = False
+        if isinstance(result, list):
+            statement.rows += len(result)
+        elif result is not None:
+            statement.rows += 1
+        _add_time(self.connection, statement, start, self._plan_parameters)
+        return result
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size: int = None):
+        return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
+class TracingConnection(sqlite3.Connection):
+    # Set on each connection, sqlite3.connect() does not pass it on
+    slow_query_seconds = float("inf")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(self._trace_callback)
+
+    def _trace_callback(self, sql: str) -> None:
+        # Statements run by a cursor, and the triggers they fire, are timed
+        # by the cursor
+        if getattr(_local, "busy", False):
+            return
+        _close_callback_statement()
+        _local.opened = self, _record(sql), time.perf_counter()
+
+    def cursor(self, factory=TracingCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def query_plan(self, sql: str, parameters=None) -> str:
+        """The EXPLAIN QUERY PLAN of a statement, as the sqlite3 shell prints
+        it, or why there is none."""
+        if parameters is None:
+            return "(no query plan)"
+        _local.busy = True
+        try:
+            rows = sqlite3.Connection.execute(
+                self, f"EXPLAIN QUERY PLAN {sql}", parameters
+            ).fetchall()
+        except sqlite3.Error as err:
+            return f"(no query plan: {err})"
+        finally:
+            _local.busy = False
+        depths = {0: 0}
+        lines = []
+        for node, parent, _, detail in rows:
+            depths[node] = depths.get(parent, 0) + 1
+            lines.append(f"{'  ' * depths[node]}{detail}")
+        return "\n".join(lines)
+
+
+class TracingMiddleware:
+    """ASGI middleware tracing the statements of each request, and adding
+    their Server-Timing header to the response, while `enabled()`."""
+
+    def __init__(self, app, enabled: Callable[[], bool]):
+        self.app = app
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled():
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        token = _request_trace.set(trace)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_trace.reset(token)
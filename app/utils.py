@@ -1,6 +1,8 @@
 import random
 import string
 
+from sqlite3 import Cursor
+
 import shortuuid
 
 def new_voucher_id_string(index: int):
@@ -9,6 +11,25 @@ def new_voucher_id_string(index: int):
     return f"{index:04d}-{stamp}"
 
 
+def reserve_voucher_ids(cur: Cursor, count: int = 1) -> range:
+    """Reserve a block of `count` consecutive voucher indices.
+
+    Must run in the transaction inserting the vouchers: the sequence row stays
+    locked until it commits, so concurrent emissions never get the same block.
+    """
+    cur.execute(
+        """
+        UPDATE sequences
+        SET value = value + :count
+        WHERE name = 'vouchers'
+        RETURNING value
+        """,
+        {"count": count},
+    )
+    (last,) = cur.fetchone()
+    return range(last - count + 1, last + 1)
+
+
 def new_user_id_string(*_, **__):
     return shortuuid.uuid()
 
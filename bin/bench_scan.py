@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import argparse
+import datetime
+import itertools
+import os
+import pathlib
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(
+    description="Compare the statements and latency per scan of the former PATCH handler and scan_voucher."
+)
+parser.add_argument("--vouchers", type=int, default=500, help="Vouchers to create")
+parser.add_argument("--rounds", type=int, default=3, help="Scan cycles per voucher")
+parser.add_argument(
+    "--state-store",
+    choices=["column", "history"],
+    default="column",
+    help="Where voucher states are stored, see LDTVOUCHERS_STATE_STORE",
+)
+
+args = parser.parse_args()
+
+tmpdir = tempfile.TemporaryDirectory()
+os.environ["LDTVOUCHERS_DB_PATH"] = str(pathlib.Path(tmpdir.name) / "bench.sqlite3")
+os.environ["LDTVOUCHERS_SERVE_STATIC_FILES"] = ""
+os.environ["LDTVOUCHERS_STATE_STORE"] = args.state_store
+
+from app import main  # noqa: E402
+
+main.init_db(main.DB_PATH)
+
+# A distributor scanning a voucher, scanning it again, then cancelling
+_SCANS = [
+    main.VoucherPatch(state=1),
+    main.VoucherPatch(state=1),
+    main.VoucherPatch(state=0),
+]
+
+
+def legacy_scan(con, user, voucherid, patch):
+    voucher = main.Voucher(**main.get_voucher(con, voucherid))
+    key = user.ac_distribute, user.ac_cashin, voucher.state, patch.state
+    if main._PATCH_VOUCHER_FUNCTIONS[key] is main._change_state:
+        main.patch_voucher(con, user, voucher, patch)
+    updated_voucher = main.Voucher(**main.get_voucher(con, voucherid))
+    key = user.ac_distribute, user.ac_cashin, voucher.state, updated_voucher.state
+    message_detail = None
+    if main._MESSAGES[key]["detail"] is main._last_state_message:
+        # Stands for the former last history message query
+        message_detail = main.Message(text=main._last_history_date(con, voucherid))
+    main.ActionResponse(
+        user=user,
+        voucher=updated_voucher,
+        message_main=main._MESSAGES[key]["main"],
+        message_detail=message_detail,
+        next_actions=main.build_next_actions(
+            user, updated_voucher, voucher.state, patch.state
+        ),
+    )
+
+
+def pipeline_scan(con, user, voucherid, patch):
+    main.scan_voucher(con, user, voucherid, patch)
+
+
+def bench(con, user, voucherids, func):
+    statements = []
+    con.set_trace_callback(statements.append)
+    scans = list(itertools.product(range(args.rounds), voucherids, _SCANS))
+    start = time.perf_counter()
+    for _, voucherid, patch in scans:
+        func(con, user, voucherid, patch)
+    elapsed = time.perf_counter() - start
+    con.set_trace_callback(None)
+    return len(statements) / len(scans), elapsed / len(scans) * 1e6
+
+
+con = main.init_con(main.DB_PATH)
+admin = main.User(
+    **main.new_user(
+        con,
+        main.UserBase(name="ADMIN", description="", ac_distribute=True, ac_cashin=True),
+    )
+)
+distributor = main.User(
+    **main.new_user(
+        con,
+        main.UserBase(name="DIST", description="", ac_distribute=True, ac_cashin=False),
+    )
+)
+expiration_date = datetime.date.today() + datetime.timedelta(days=1)
+voucherids = [
+    main.new_voucher(
+        con,
+        admin,
+        main.VoucherBase(label="", expiration_date=expiration_date, value=20, state=0),
+    )["id"]
+    for _ in range(args.vouchers)
+]
+
+for name, func in (("legacy", legacy_scan), ("pipeline", pipeline_scan)):
+    statements, latency = bench(con, distributor, voucherids, func)
+    print(f"{name:>8}: {statements:.2f} statements/scan, {latency:.1f} us/scan")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import csv
+import datetime
+import os
+import sys
+import time
+
+from pydantic import ValidationError
+
+_CSV_COLUMNS = ("label", "expiration_date", "value")
+
+parser = argparse.ArgumentParser(
+    description="Emit new vouchers in a database and print them as CSV."
+)
+parser.add_argument("db", type=str, help="Path to the database")
+parser.add_argument(
+    "--user", required=True, help="Id of the user emitting the vouchers"
+)
+parser.add_argument("--count", type=int, help="Number of vouchers to emit")
+parser.add_argument("--value", type=int, help="Value of the vouchers, in dollars")
+parser.add_argument(
+    "--expiration-date",
+    type=datetime.date.fromisoformat,
+    help="Expiration date of the vouchers, YYYY-MM-DD",
+)
+parser.add_argument("--label", default="", help="Label of the vouchers")
+parser.add_argument(
+    "--csv",
+    type=argparse.FileType("r"),
+    help="CSV file with label, expiration_date and value columns, - for stdin",
+)
+
+args = parser.parse_args()
+
+os.environ["LDTVOUCHERS_DB_PATH"] = args.db
+os.environ["LDTVOUCHERS_SERVE_STATIC_FILES"] = ""
+
+# Keep stdout for the CSV
+with contextlib.redirect_stdout(sys.stderr):
+    from app import main  # noqa: E402
+
+    main.init_db(main.DB_PATH)
+
+if args.csv:
+    reader = csv.DictReader(args.csv)
+    missing = [name for name in _CSV_COLUMNS if name not in (reader.fieldnames or ())]
+    if missing:
+        parser.error(f"--csv: missing columns {', '.join(missing)}")
+    vouchers = []
+    # Other columns, e.g. the id and state of generate_stub_table.py, are ignored
+    for row in reader:
+        try:
+            values = {name: row[name] for name in _CSV_COLUMNS}
+            vouchers.append(main.VoucherBase(state=0, **values))  # registered
+        except ValidationError as err:
+            parser.error(f"--csv: line {reader.line_num}: {err}")
+elif None in (args.count, args.value, args.expiration_date):
+    parser.error("--count, --value and --expiration-date are required without --csv")
+else:
+    vouchers = [
+        main.VoucherBase(
+            label=args.label,
+            expiration_date=args.expiration_date,
+            value=args.value,
+            state=0,  # registered
+        )
+    ] * args.count
+
+con = main.init_con(main.DB_PATH)
+user = main.get_user(con, args.user)
+if not user:
+    sys.exit(f"Unknown user: {args.user}")
+
+start = time.perf_counter()
+ids = main.new_vouchers(con, main.User(**user), vouchers)
+seconds = time.perf_counter() - start
+
+w = csv.writer(sys.stdout, dialect="excel")
+w.writerow(["id", "label", "expiration_date", "value"])
+for voucherid, voucher in zip(ids, vouchers):
+    w.writerow([voucherid, voucher.label, voucher.expiration_date, voucher.value])
+
+print(
+    f"Emitted {len(ids)} vouchers in {seconds:.2f}s "
+    f"({len(ids) / seconds:.0f} vouchers/s)",
+    file=sys.stderr,
+)
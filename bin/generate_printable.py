@@ -3,54 +3,15 @@
 import argparse
 import datetime
 import itertools
-import json
 import pathlib
 import sqlite3
-import string
+import sys
+import time
 
-import jinja2
+from app import migrations, printables, qrcodes
 
-_DATE_NOW = datetime.datetime.now().isoformat()
-
-def group(iterator, count, default_factory):
-    group = []
-    for item in iterator:
-        group.append(item)
-        if len(group) == count:
-            yield tuple(group)
-            group.clear()
-
-    if group:
-        yield tuple(group)
-
-
-def pad(items, count, default_factory):
-    yield from items
-    for _ in range(count - len(items)):
-        yield default_factory()
-
-
-def last_valid(items):
-    for item in reversed(items):
-        if item:
-            return item
-
-
-def build_voucher_template_dict(prefix, row):
-    if not row:
-        return {
-            f"{prefix}v": "",
-            f"{prefix}l": "",
-            f"{prefix}i": "",
-            f"{prefix}c": "empty.svg",
-        }
-
-    return {
-        f"{prefix}v": f"{row['value']}$",
-        f"{prefix}l": row["label"],
-        f"{prefix}i": row["id"],
-        f"{prefix}c": row["qrcode"],
-    }
+# The day only, so that the pages of a reprint on the same day are unchanged
+_DATE_NOW = datetime.date.today().isoformat()
 
 
 parser = argparse.ArgumentParser(
@@ -61,103 +22,199 @@ parser.add_argument(
     type=pathlib.Path,
     help="Path to the database",
 )
+parser.add_argument(
+    "--label",
+    help="Only the vouchers of this campaign",
+)
+parser.add_argument(
+    "--expiration-date",
+    help="Only the vouchers expiring on this date, YYYY-MM-DD",
+)
+parser.add_argument(
+    "--state",
+    choices=["registered", "distributed", "cashedin", "expired", "deactivated"],
+    help="Only the vouchers in this state",
+)
+parser.add_argument(
+    "--after",
+    metavar="VOUCHERID",
+    help="Only the vouchers after this one, to resume an interrupted run",
+)
+parser.add_argument(
+    "--only",
+    choices=["vouchers", "users"],
+    help="Only generate the vouchers or the users pages",
+)
+parser.add_argument(
+    "--render",
+    action="store_true",
+    help="Render vouchers.pdf and users.pdf in-process instead of writing build.ninja, "
+    "as vector PDFs embedding each background image once",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    help="Number of rendering processes with --render, defaults to the number of CPUs",
+)
 
 args = parser.parse_args()
 
 root_dir = pathlib.Path(__file__).parent.parent
 templates_dir = root_dir / "templates" / "printables"
 
-subninja_paths = []
-
 conn = sqlite3.connect(args.db)
 conn.row_factory = sqlite3.Row
+# select_vouchers needs the vouchers_label index, which the server may not
+# have created yet
+migrations.migrate(conn)
+
+# An unknown voucher would silently select nothing
+if args.after is not None:
+    cur = conn.execute("SELECT 1 FROM vouchers WHERE id = ?", (args.after,))
+    if cur.fetchone() is None:
+        parser.error(f"--after: unknown voucher {args.after}")
+
+# Rows are streamed from the cursors and grouped into sheets lazily
+voucher_sheets = iter(())
+if args.only != "users":
+    voucher_sheets = printables.voucher_sheets(
+        printables.select_vouchers(
+            conn,
+            label=args.label,
+            expiration_date=args.expiration_date,
+            state=args.state,
+            after=args.after,
+        ),
+        _DATE_NOW,
+    )
+user_sheets = iter(())
+if args.only != "vouchers":
+    user_sheets = printables.user_sheets(printables.select_users(conn), _DATE_NOW)
+
+if args.render:
+    cache_dir = pathlib.Path("tmp/cache")
+    rendered = []
+    for name, sheets, pages in (
+        ("vouchers.pdf", voucher_sheets, printables.voucher_pages),
+        ("users.pdf", user_sheets, printables.user_pages),
+    ):
+        start = time.perf_counter()
+        paths = printables.render(
+            itertools.chain.from_iterable(map(pages, sheets)),
+            templates_dir,
+            cache_dir,
+            jobs=args.jobs,
+        )
+        rendered.extend(paths)
+        if paths:
+            printables.unite(paths, pathlib.Path(name))
+        seconds = time.perf_counter() - start
+        print(
+            f"Rendered {name}: {len(paths)} pages in {seconds:.2f}s "
+            f"({len(paths) / seconds:.1f} pages/s)",
+            file=sys.stderr,
+        )
+    # A subset run would drop the cached pages of the other vouchers
+    if not any((args.label, args.expiration_date, args.state, args.after, args.only)):
+        printables.prune(cache_dir, rendered)
+    sys.exit()
+
+env = printables.environment(templates_dir)
 
-env = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(templates_dir),
-    autoescape=jinja2.select_autoescape(["html", "xml"]),
-)
+subninja_paths = []
 
 # Vouchers
 
-vouchers_per_page = 6
+# The sides of the sheets, the ones whose template has no variables are built
+# once in static_root and shared by all the sheets
+sides = ["recto", "verso"]
+static_sides = [
+    side for side in sides if printables.is_static(env, f"vouchers/{side}.svg")
+]
+static_root = pathlib.Path("tmp/vouchers/static")
 
-voucher_pages = []
 
-res = conn.execute("SELECT * FROM vouchers").fetchall()
-for rows in group(res, vouchers_per_page, dict):
-    # Create the folder from the vouchers page
+def write_vouchers_build(root, pages, vouchers, data):
+    assets = set()
+    for page in pages:
+        assets.update(printables.template_assets(env, f"vouchers/{page}.svg"))
+    if printables.EMPTY_QRCODE in data.values():
+        assets.add(printables.EMPTY_QRCODE)
+
+    # Dump the JSON
+
+    data_path = root / "data.json"
+    printables.write_if_changed(data_path, printables.dump_json(data))
+
+    # Dump the ninja.build
 
-    first, last = rows[0], rows[-1]
-    root = pathlib.Path(
-        f"tmp/vouchers/{first['label']}-{last['label']}-{first['id']}-{last['id']}"
+    build = root / "ninja.build"
+
+    content = env.get_template("vouchers/build.ninja").render(
+        templatesdir=templates_dir / "vouchers",
+        assets=sorted(assets),
+        root=root,
+        data=data_path.name,
+        pages=pages,
+        vouchers=vouchers,
     )
-    root.mkdir(exist_ok=True, parents=True)
+    printables.write_if_changed(build, content)
 
-    # Add qrcode paths to the rows data
+    subninja_paths.append(build)
 
-    rows = [dict(
-            date_now=_DATE_NOW,
-            qrcode=f"qrcode-{row['id']}.svg",
-            **row) for row in rows]
 
-    # Dump the JSON
+voucher_pages = []
 
-    data_dict = {}
-    for prefix, row in itertools.zip_longest(
-        string.ascii_lowercase[:vouchers_per_page], rows
-    ):
-        data_dict.update(build_voucher_template_dict(prefix, row))
+for sheet in voucher_sheets:
+    if static_sides and not voucher_pages:
+        static_root.mkdir(exist_ok=True, parents=True)
+        write_vouchers_build(static_root, static_sides, [], {})
 
-    data = root / "data.json"
-    with data.open("w") as fp:
-        json.dump(data_dict, fp, sort_keys=True, indent=4)
+    # Create the folder from the vouchers page
 
-    # Output PDFs
+    root = sheet.root
+    root.mkdir(exist_ok=True, parents=True)
 
-    recto = root / "recto.pdf"
-    verso = root / "verso.pdf"
+    # Write the QR codes
 
-    # Dump the ninja.build
+    for voucher in sheet.items:
+        printables.write_if_changed(
+            root / voucher["qrcode"], qrcodes.render(voucher["id"])
+        )
 
-    build = root / "ninja.build"
+    write_vouchers_build(
+        root,
+        [side for side in sides if side not in static_sides],
+        sheet.items,
+        sheet.data,
+    )
 
-    env.get_template("vouchers/build.ninja").stream(
-        templatesdir=templates_dir / "vouchers",
-        assets=["empty.svg", "logo-clubpop.png", "logo-detour.jpg", "recto.png", "verso.png"],
-        root=root,
-        data=data.name,
-        recto=recto.name,
-        verso=verso.name,
-        vouchers=rows,
-    ).dump(str(build))
+    # Output PDFs
 
-    subninja_paths.append(build)
-    voucher_pages.append(recto)
-    voucher_pages.append(verso)
+    for side in sides:
+        voucher_pages.append(
+            (static_root if side in static_sides else root) / f"{side}.pdf"
+        )
 
 # Users
 
 users_pages = []
 
-res = conn.execute("SELECT * FROM users").fetchall()
-for user in res:
+for sheet in user_sheets:
     # Create the folder from the user page
-    root = pathlib.Path(f"tmp/users/{user['id']}")
+    root = sheet.root
     root.mkdir(exist_ok=True, parents=True)
 
-    # Add qrcode paths to the rows data
-
-    user = dict(
-        date_now=_DATE_NOW,
-        qrcode="qrcode.svg",
-        **user
-    )
-
     # Dump the JSON
 
     data = root / "data.json"
-    with data.open("w") as fp:
-        json.dump(user, fp, sort_keys=True, indent=4)
+    printables.write_if_changed(data, printables.dump_json(sheet.data))
+
+    # Write the QR code
+
+    printables.write_if_changed(
+        root / sheet.data["qrcode"], qrcodes.render(sheet.data["id"])
+    )
 
     # Output PDF
 
@@ -167,9 +224,10 @@ for user in res:
 
     build = root / "ninja.build"
 
-    env.get_template("users/build.ninja").stream(
-        root=root, data=data.name, user=user, page=page.name
-    ).dump(str(build))
+    content = env.get_template("users/build.ninja").render(
+        root=root, data=data.name, user=sheet.data, page=page.name
+    )
+    printables.write_if_changed(build, content)
 
     subninja_paths.append(build)
 
@@ -179,11 +237,12 @@ for user in res:
 # Main
 
 template = env.get_template("build.ninja")
-template.stream(
+content = template.render(
     db=args.db,
     render_jinja_template=root_dir / "bin" / "render_jinja_template.py",
     templates_dir=templates_dir,
     subninja_paths=subninja_paths,
     voucher_pages=voucher_pages,
     users_pages=users_pages,
-).dump("build.ninja")
+)
+printables.write_if_changed(pathlib.Path("build.ninja"), content)
@@ -7,7 +7,7 @@ import sys
 
 import shortuuid
 
-from app import utils
+from app import migrations, utils
 
 _MAKE_ID_FUNC = {
     "vouchers": utils.new_voucher_id_string,
@@ -27,6 +27,8 @@ parser.add_argument("count", type=int, help="Number of lines to generate")
 args = parser.parse_args()
 
 conn = sqlite3.connect(args.db)
+# reserve_voucher_ids needs the sequences table
+migrations.migrate(conn)
 info = conn.execute(
     f"PRAGMA table_info({args.table})"
 ).fetchall()  # List[Tuple[index, name, type, ?, ?, ?]]
@@ -37,9 +39,16 @@ w.writerow(column_names)
 
 make_id_func = _MAKE_ID_FUNC[args.table]
 
-for i in range(args.count):
+# Reserve the voucher indices in the database, so that the stub ids never
+# collide with vouchers emitted in the meantime
+indices = range(1, args.count + 1)
+if args.table == "vouchers":
+    with conn:
+        indices = utils.reserve_voucher_ids(conn.cursor(), args.count)
+
+for i in indices:
     row = [""] * len(column_names)
-    row[column_names.index("id")] = make_id_func(i+1)
+    row[column_names.index("id")] = make_id_func(i)
     w.writerow(row)
 
 sys.stdout.flush
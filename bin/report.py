@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import sqlite3
+import sys
+
+from app import migrations, reports
+
+parser = argparse.ArgumentParser(
+    description="Maintain and export the voucher_report table."
+)
+parser.add_argument("command", choices=["check", "rebuild", "export", "commit"])
+parser.add_argument("db", type=str, help="Path to the database")
+parser.add_argument("--report", help="export: path of the report CSV to write")
+parser.add_argument("--history", help="export: path of the history CSV to write")
+parser.add_argument(
+    "--full", action="store_true", help="export: everything, not only the changes"
+)
+parser.add_argument(
+    "--full-every",
+    type=float,
+    metavar="DAYS",
+    help="export: everything if the last full export is older than DAYS",
+)
+parser.add_argument(
+    "--pending",
+    action="store_true",
+    help="export: only count the export once committed, e.g. after mailing it",
+)
+parser.add_argument("--id", type=int, help="commit: id of the export to commit")
+
+args = parser.parse_args()
+
+if args.command == "export" and not (args.report and args.history):
+    parser.error("export requires --report and --history")
+if args.command == "commit" and args.id is None:
+    parser.error("commit requires --id")
+
+conn = sqlite3.connect(args.db)
+conn.row_factory = sqlite3.Row
+# Run by cron: the server may not have migrated the database yet
+migrations.migrate(conn)
+
+if args.command == "rebuild":
+    count = reports.rebuild(conn)
+    print(f"Rebuilt voucher_report: {count} rows", file=sys.stderr)
+
+elif args.command == "check":
+    rows = reports.check(conn)
+    if rows:
+        w = csv.writer(sys.stdout, dialect="excel")
+        w.writerow(rows[0].keys())
+        w.writerows(rows)
+        sys.exit(f"voucher_report differs from v_report on {len(rows)} rows")
+
+elif args.command == "export":
+    full = args.full or (
+        args.full_every is not None and reports.full_export_due(conn, args.full_every)
+    )
+    with open(args.report, "w", newline="") as report, open(
+        args.history, "w", newline=""
+    ) as history:
+        run = reports.export(conn, report, history, full=full, commit=not args.pending)
+    print(
+        f"Exported {run['report_rows']} report rows and {run['history_rows']} "
+        f"history rows, up to history id {run['last_history_id']}",
+        file=sys.stderr,
+    )
+    # For send_report.sh
+    print("full" if run["full"] else "incremental", run["id"])
+
+elif args.command == "commit":
+    if not reports.commit_export(conn, args.id):
+        sys.exit(f"Unknown export: {args.id}")
@@ -29,8 +29,11 @@ _history_url=$_url_root/$_history_name
 
 mkdir -pv $_dir
 
-sqlite3 -header -csv $_db "select * from v_report;" > $_report
-sqlite3 -header -csv $_db "select * from v_history;" > $_history
+# Only the changes since the previous report, and everything once a week.
+# The export only counts once the mail is sent: a failed run is exported again.
+_full_every=${LDTVOUCHERS_REPORT_FULL_EVERY:-7}
+_export=`python $(dirname $0)/report.py export $_db --report $_report --history $_history --full-every $_full_every --pending` || exit 1
+read _kind _export_id <<< "$_export"
 
 _mail=/tmp/ledetour-vouchers-report-email.txt
 
@@ -40,6 +43,10 @@ echo "Subject: Bons d'achats" >> $_mail
 echo >> $_mail
 echo "Bonjour l'équipe des Bons Solidaires," >> $_mail
 echo "ci-joint à ce message automatique le rapport des Bons Solidaires au $_stamp:" >> $_mail
+if [ "$_kind" = "incremental" ]
+then
+    echo "(bons modifiés depuis le rapport précédent seulement)" >> $_mail
+fi
 echo "- Rapport: $_report_url" >> $_mail
 echo "- Historique: $_history_url" >> $_mail
 
@@ -49,4 +56,7 @@ curl \
     --mail-from 'charles@epicerieledetour.org' \
     --mail-rcpt 'charles.fleche@free.fr' \
     --user "charles@epicerieledetour.org:$LDTVOUCHERS_MAIL_PASSWORD" \
-    --upload-file $_mail
+    --upload-file $_mail \
+    || exit 1
+
+python $(dirname $0)/report.py commit $_db --id $_export_id || exit 1
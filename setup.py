@@ -5,7 +5,7 @@ setup(
     version="0.0.0",
     include_package_data=True,
     packages=["app"],
-    scripts=["bin/send_report.sh"],
+    scripts=["bin/send_report.sh", "bin/report.py"],
     python_requires=">=3.7",
-    install_requires=["fastapi", "uvicorn[standard]", "Jinja2", "shortuuid"],
+    install_requires=["fastapi", "uvicorn[standard]", "Jinja2", "segno", "shortuuid"],
 )
@@ -0,0 +1,53 @@
+from pytest import fixture
+
+from app import cache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@fixture
+def clock():
+    return Clock()
+
+
+def test_ttl_cache__expires(clock):
+    c = cache.TTLCache(ttl=10, clock=clock)
+    assert c.set("a", 1) == 1
+    clock.now = 9.9
+    assert c.get("a") == 1
+    clock.now = 10
+    assert c.get("a") is None
+    assert len(c) == 0
+
+
+def test_ttl_cache__maxsize(clock):
+    c = cache.TTLCache(ttl=10, maxsize=2, clock=clock)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.set("a", 3)
+    c.set("c", 4)
+    assert c.get("b") is None
+    assert c.get("a") == 3
+    assert c.get("c") == 4
+
+
+def test_ttl_cache__invalidate(clock):
+    c = cache.TTLCache(ttl=10, clock=clock)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.invalidate("a")
+    assert c.get("a") is None
+    c.clear()
+    assert c.get("b") is None
+
+
+def test_ttl_cache__disabled(clock):
+    c = cache.TTLCache(ttl=0, clock=clock)
+    c.set("a", 1)
+    assert c.get("a") is None
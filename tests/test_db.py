@@ -0,0 +1,96 @@
+import asyncio
+import sqlite3
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pytest import fixture, raises
+
+from app import db
+
+
+@fixture
+def pool(tmpdir):
+    uri = tmpdir / "db.sqlite3"
+    pool = db.ConnectionPool(
+        lambda: sqlite3.connect(uri, check_same_thread=False), size=2, timeout=0.01
+    )
+    yield pool
+    pool.close()
+
+
+def test_pool__reuses_connections(pool):
+    with pool.connection() as con:
+        pass
+    with pool.connection() as other:
+        assert other is con
+
+
+def test_pool__is_bounded(pool):
+    with pool.connection(), pool.connection():
+        with raises(db.PoolTimeout):
+            pool.checkout()
+        assert pool.in_use == 2
+    with pool.connection():
+        assert pool.in_use == 1
+    assert pool.in_use == 0
+
+
+def test_pool__replaces_broken_connections(pool):
+    with pool.connection() as con:
+        pass
+    con.close()
+    with pool.connection() as other:
+        assert other is not con
+        assert other.execute("SELECT 1").fetchone() == (1,)
+
+
+def test_pool__rolls_back_on_checkin(pool):
+    with pool.connection() as con:
+        con.execute("CREATE TABLE t (x INTEGER)")
+        con.commit()
+        con.execute("INSERT INTO t VALUES (1)")
+        assert con.in_transaction
+    with pool.connection() as con:
+        assert not con.in_transaction
+        assert con.execute("SELECT COUNT(*) FROM t").fetchone() == (0,)
+
+
+def test_apply_pragmas(tmpdir):
+    con = sqlite3.connect(tmpdir / "db.sqlite3")
+    db.apply_pragmas(
+        con, {"journal_mode": "WAL", "synchronous": "normal", "busy_timeout": "250"}
+    )
+    assert con.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert con.execute("PRAGMA synchronous").fetchone() == (1,)
+    assert con.execute("PRAGMA busy_timeout").fetchone() == (250,)
+
+
+def test_apply_pragmas__invalid(tmpdir):
+    con = sqlite3.connect(tmpdir / "db.sqlite3")
+    with raises(ValueError):
+        db.apply_pragmas(con, {"journal_mode": "wal; DROP TABLE users"})
+    with raises(ValueError):
+        db.apply_pragmas(con, {"cache_size": "big"})
+    with raises(ValueError):
+        db.apply_pragmas(con, {"foreign_keys": "on"})
+
+
+def test_pragma_value():
+    assert db.pragma_value("synchronous", "NORMAL") == "normal"
+    assert db.pragma_value("mmap_size", "0") == 0
+    with raises(ValueError, match="cache_size"):
+        db.pragma_value("cache_size", "big")
+
+
+def test_run_in_executor():
+    def func(value, *, offset):
+        return threading.current_thread().name, value + offset
+
+    async def main():
+        with ThreadPoolExecutor(thread_name_prefix="test-db") as executor:
+            return await db.run_in_executor(executor, func, 1, offset=2)
+
+    name, value = asyncio.run(main())
+    assert name.startswith("test-db")
+    assert value == 3
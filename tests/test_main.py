@@ -1,12 +1,19 @@
+import csv
 import datetime
+import io
+import itertools
+import json
+import pathlib
+import subprocess
+import sys
 
 from fastapi import status
 from fastapi.testclient import TestClient
 from requests.auth import AuthBase
 
-from pytest import fixture
+from pytest import fixture, mark, raises
 
-from app import main
+from app import main, migrations
 
 
 class BearerAuth(AuthBase):
@@ -30,6 +37,7 @@ def con_uri(tmpdir):
 
 @fixture
 def con(con_uri):
+    main.init_db(con_uri)
     return main.init_con(con_uri)
 
 
@@ -130,16 +138,18 @@ def voucher_spent(con, user_admin, user_distributor, user_cashier, expiration_da
 
 
 @fixture
-def app(con):
+def app(con, con_uri):
     def get_con():
-        try:
-            yield con
-        finally:
-            con.close()
+        yield con
+
+    def get_read_only_con():
+        return main.init_con(con_uri, read_only=True)
 
     main.app.dependency_overrides[main.get_con] = get_con
+    main.app.dependency_overrides[main.get_read_only_con] = get_read_only_con
     yield main.app
     del main.app.dependency_overrides[main.get_con]
+    del main.app.dependency_overrides[main.get_read_only_con]
 
 
 @fixture
@@ -154,6 +164,13 @@ def distributor_client(app, user_distributor):
     return client
 
 
+@fixture
+def admin_client(app, user_admin):
+    client = TestClient(app)
+    client.auth = BearerAuth(user_admin.id)
+    return client
+
+
 @fixture
 def cashier_client(app, user_cashier):
     client = TestClient(app)
@@ -214,6 +231,19 @@ def test_auth__get__cashier(cashier_client, user_cashier):
     }
 
 
+def test_auth__get__cached_user(con_uri, distributor_client, user_distributor):
+    assert distributor_client.get("/api/auth").status_code == status.HTTP_200_OK
+
+    con = main.init_con(con_uri)
+    with con:
+        con.execute("DELETE FROM users WHERE id=?", (user_distributor.id,))
+    assert distributor_client.get("/api/auth").status_code == status.HTTP_200_OK
+
+    main.users_cache.invalidate(user_distributor.id)
+    response = distributor_client.get("/api/auth")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
 def test_vouchers__patch__unauthenticated(unauthenticated_client, voucher_registered):
     response = unauthenticated_client.patch(
         f"/api/vouchers/{voucher_registered.id}", data={"state": 0}
@@ -375,6 +405,37 @@ def test_vouchers_patch__distributor__spent_to_distributed(
     }
 
 
+def test_vouchers_patch__distributor__registered_to_registered(
+    distributor_client, user_distributor, voucher_registered
+):
+    response = distributor_client.patch(
+        f"/api/vouchers/{voucher_registered.id}", json={"state": 0}
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    expected_action_response = main.ActionResponse(**response.json())
+    assert expected_action_response.dict() == {
+        "user": user_distributor.dict(),
+        "voucher": voucher_registered,
+        "message_main": {"text": "Not yet distributed", "severity": 2},
+        "message_detail": None,
+        "next_actions": {
+            "scan": {
+                "url": "/api/vouchers/{code}",
+                "verb": "PATCH",
+                "body": {"state": 1},
+                "message": {"text": "Scan to distribute a voucher", "severity": 0},
+            },
+            "button": {
+                "url": f"/api/vouchers/{voucher_registered.id}",
+                "verb": "PATCH",
+                "body": {"state": 1},
+                "message": {"text": "Distribute", "severity": 1},
+            },
+        },
+    }
+
+
 # Cashier tests
 
 
@@ -523,6 +584,597 @@ def test_vouchers__history(voucher_spent):
     assert voucher_spent.history[2].startswith("Registered by ADMIN ")
 
 
+@mark.parametrize("state", [0, 1])
+def test_vouchers_patch__uses_indexes(
+    con, con_uri, distributor_client, voucher_distributed, state
+):
+    statements = []
+    con.set_trace_callback(statements.append)
+    response = distributor_client.patch(
+        f"/api/vouchers/{voucher_distributed.id}", json={"state": state}
+    )
+    assert response.status_code == status.HTTP_200_OK
+
+    con = main.init_con(con_uri)
+    queries = [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+    assert queries
+    for query in queries:
+        plan = con.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        for row in plan:
+            assert not row["detail"].startswith("SCAN"), (query, row["detail"])
+
+
+@mark.parametrize("state, count", [(0, 5), (1, 3)])
+def test_vouchers_patch__statements(
+    con, distributor_client, voucher_distributed, state, count
+):
+    statements = []
+    con.set_trace_callback(statements.append)
+    response = distributor_client.patch(
+        f"/api/vouchers/{voucher_distributed.id}", json={"state": state}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    # Statements run by triggers are traced as repeats of the triggering one
+    statements = [s for s, _ in itertools.groupby(statements)]
+    queries = [s for s in statements if not s.startswith(("BEGIN", "COMMIT"))]
+    assert len(queries) == count, queries
+
+
+@fixture
+def history_store(monkeypatch, con):
+    monkeypatch.setattr(main.config, "STATE_STORE", "history")
+    main.states.use_store(con, "history")
+    main.latest_states.warm(con)
+    yield
+    main.latest_states.clear()
+
+
+# Once read, the voucher row is cached: a transition is a single append, and
+# an answer without one reads the latest state, as our map may be stale
+@mark.parametrize("state, count", [(0, 3), (1, 3)])
+def test_vouchers_patch__statements__history_store(
+    con, voucher_distributed, history_store, distributor_client, state, count
+):
+    main.latest_states.voucher(con, voucher_distributed.id)
+    statements = []
+    con.set_trace_callback(statements.append)
+    response = distributor_client.patch(
+        f"/api/vouchers/{voucher_distributed.id}", json={"state": state}
+    )
+    assert response.status_code == status.HTTP_200_OK
+    statements = [s for s, _ in itertools.groupby(statements)]
+    queries = [s for s in statements if not s.startswith(("BEGIN", "COMMIT"))]
+    assert len(queries) == count, queries
+
+
+def test_vouchers_patch__history_store(
+    con, voucher_registered, history_store, distributor_client
+):
+    voucherid = voucher_registered.id
+    response = distributor_client.patch(f"/api/vouchers/{voucherid}", json={"state": 1})
+    assert response.json()["voucher"]["state"] == 1
+    assert response.json()["message_main"]["text"] == "Distributed"
+    assert main.get_voucher(con, voucherid)["state"] == 1
+    assert len(main.get_voucher_history(con, voucherid)) == 2
+    # Only history is written
+    row = con.execute("SELECT state FROM vouchers WHERE id=?", (voucherid,))
+    assert row.fetchone()[0] == 0
+
+    # Leaving the history store brings vouchers.state up to date
+    assert main.states.use_store(con, "column") == 1
+    row = con.execute("SELECT state FROM vouchers WHERE id=?", (voucherid,))
+    assert row.fetchone()[0] == 1
+
+
+def test_vouchers_patch__history_store__stale_state(
+    con, user_distributor, voucher_registered, history_store, distributor_client
+):
+    # Another process distributes the voucher, our map still says registered
+    voucherid = voucher_registered.id
+    with con:
+        main.states.append_state(con, user_distributor.id, voucherid, 0, 1)
+    response = distributor_client.patch(f"/api/vouchers/{voucherid}", json={"state": 1})
+    assert response.json()["voucher"]["state"] == 1
+    assert response.json()["message_main"]["text"] == "Already distributed"
+    assert len(main.get_voucher_history(con, voucherid)) == 2
+
+
+def test_vouchers_patch__history_store__stale_kept_state(
+    con, user_distributor, voucher_distributed, history_store, distributor_client
+):
+    # Another process cancels the distribution, our map still says distributed
+    voucherid = voucher_distributed.id
+    with con:
+        main.states.append_state(con, user_distributor.id, voucherid, 1, 0)
+    response = distributor_client.patch(f"/api/vouchers/{voucherid}", json={"state": 1})
+    assert response.json()["voucher"]["state"] == 1
+    assert response.json()["message_main"]["text"] == "Distributed"
+    assert main.states.latest_state(con, voucherid) == 1
+
+
+def test_vouchers_patch__history_store__stale_refused_state(
+    con, user_cashier, voucher_distributed, history_store, distributor_client
+):
+    # Our map wrongly says cashed in, from which cancelling is refused
+    voucherid = voucher_distributed.id
+    main.latest_states.set(voucherid, 2)
+    response = distributor_client.patch(f"/api/vouchers/{voucherid}", json={"state": 0})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["voucher"]["state"] == 0
+
+
+def test_vouchers_patch__history_store__no_history(
+    con, history_store, distributor_client, expiration_date
+):
+    # Imported with `sqlite3 .import`: its state is vouchers.state
+    with con:
+        con.execute(
+            "INSERT INTO vouchers VALUES ('0001-IMPRT', 'Camp', ?, 20, 0)",
+            (expiration_date.date().isoformat(),),
+        )
+    for state, text in ((0, "Not yet distributed"), (1, "Distributed")):
+        response = distributor_client.patch(
+            "/api/vouchers/0001-IMPRT", json={"state": state}
+        )
+        assert response.json()["message_main"]["text"] == text
+    assert main.states.latest_state(con, "0001-IMPRT") == 1
+
+
+def test_vouchers_patch__history_store__attempts(
+    monkeypatch, con, voucher_registered, history_store, distributor_client
+):
+    # Whatever goes wrong, a scan gives up instead of holding the write lock
+    monkeypatch.setattr(main.states, "append_state", lambda *args: False)
+    response = distributor_client.patch(
+        f"/api/vouchers/{voucher_registered.id}", json={"state": 1}
+    )
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert not con.in_transaction
+
+
+def test_vouchers_patch__unknown_voucher(distributor_client):
+    response = distributor_client.patch("/api/vouchers/unknown", json={"state": 1})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json() == {"detail": "Not found"}
+
+
+def test_new_voucher__sequential_ids(voucher_registered, voucher_distributed):
+    assert voucher_registered.id.startswith("0001-")
+    assert voucher_distributed.id.startswith("0002-")
+
+
+def test_new_voucher__id_collision(
+    monkeypatch, con, user_admin, voucher_registered, expiration_date
+):
+    ids = iter([voucher_registered.id, "0002-OTHER"])
+    monkeypatch.setattr(main.utils, "new_voucher_id_string", lambda index: next(ids))
+    values = main.new_voucher(
+        con,
+        user_admin,
+        main.VoucherBase(
+            label="Voucher", expiration_date=expiration_date, value=20, state=0
+        ),
+    )
+    assert values["id"] == "0002-OTHER"
+
+
+def test_new_vouchers__id_collision(
+    monkeypatch, con, user_admin, voucher_registered, expiration_date
+):
+    ids = iter([voucher_registered.id, "0002-B", "0002-C", "0003-D"])
+    monkeypatch.setattr(main.utils, "new_voucher_id_string", lambda index: next(ids))
+    voucher = main.VoucherBase(
+        label="Voucher", expiration_date=expiration_date, value=20, state=0
+    )
+    assert main.new_vouchers(con, user_admin, [voucher, voucher]) == [
+        "0002-C",
+        "0003-D",
+    ]
+    assert not main.get_voucher(con, "0002-B")
+
+
+def test_vouchers_bulk(con, admin_client, user_admin, expiration_date):
+    response = admin_client.post(
+        "/api/vouchers:bulk",
+        json={
+            "count": 3,
+            "label": "Campaign",
+            "expiration_date": expiration_date.date().isoformat(),
+            "value": 20,
+        },
+    )
+    assert response.status_code == status.HTTP_200_OK
+    result = response.json()
+    assert result["vouchers_per_second"] > 0
+    assert [voucherid[:4] for voucherid in result["ids"]] == ["0001", "0002", "0003"]
+    for voucherid in result["ids"]:
+        voucher = main.Voucher(**main.get_voucher(con, voucherid))
+        assert voucher.label == "Campaign"
+        assert voucher.state == 0
+        assert voucher.history[0].startswith("Registered by ADMIN ")
+
+
+def test_vouchers_bulk__not_admin(distributor_client, expiration_date):
+    response = distributor_client.post(
+        "/api/vouchers:bulk",
+        json={
+            "count": 3,
+            "expiration_date": expiration_date.date().isoformat(),
+            "value": 20,
+        },
+    )
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_scans(con, distributor_client, voucher_registered, voucher_spent):
+    response = distributor_client.post(
+        "/api/scans",
+        json={
+            "scans": [
+                {
+                    "voucherid": voucher_registered.id,
+                    "state": 1,  # distributed
+                    "client_timestamp": "2024-01-01T10:00:00",
+                    "idempotency_key": "a",
+                },
+                {"voucherid": "unknown", "state": 1, "idempotency_key": "b"},
+                {"voucherid": voucher_spent.id, "state": 0, "idempotency_key": "c"},
+                # Retried scan, then a cancellation
+                {
+                    "voucherid": voucher_registered.id,
+                    "state": 1,
+                    "idempotency_key": "a",
+                },
+                {
+                    "voucherid": voucher_registered.id,
+                    "state": 0,
+                    "idempotency_key": "d",
+                },
+            ]
+        },
+    )
+    assert response.status_code == status.HTTP_200_OK
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 404, 401, 200, 200]
+    assert results[0]["client_timestamp"] == "2024-01-01T10:00:00"
+    assert results[0]["response"]["voucher"]["state"] == 1
+    assert results[0]["response"]["message_main"]["text"] == "Distributed"
+    assert results[3]["response"] == results[0]["response"]
+    assert results[1]["detail"] == "Not found" and results[1]["response"] is None
+    assert results[4]["response"]["voucher"]["state"] == 0
+
+    voucher = main.Voucher(**main.get_voucher(con, voucher_registered.id))
+    assert voucher.state == 0
+    assert len(voucher.history) == 3
+
+
+def test_scans__idempotency_keys_across_batches(
+    con, distributor_client, voucher_registered
+):
+    def scan(state):
+        scan = {"voucherid": voucher_registered.id, "state": state}
+        return {**scan, "idempotency_key": "a"}
+
+    distributor_client.post("/api/scans", json={"scans": [scan(1)]})
+    response = distributor_client.post("/api/scans", json={"scans": [scan(1)]})
+    (result,) = response.json()["results"]
+    assert result["response"]["voucher"]["state"] == 1
+    assert len(main.get_voucher_history(con, voucher_registered.id)) == 2
+
+
+def test_scans__idempotency_key__other_scan(distributor_client, voucher_registered):
+    scan = {"voucherid": voucher_registered.id, "state": 1, "idempotency_key": "a"}
+    response = distributor_client.post(
+        "/api/scans", json={"scans": [scan, {**scan, "state": 0}]}
+    )
+    results = response.json()["results"]
+    assert [result["status_code"] for result in results] == [200, 422]
+    assert results[1]["response"] is None
+
+
+def test_scans__unauthenticated(unauthenticated_client):
+    response = unauthenticated_client.post("/api/scans", json={"scans": []})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def _patch_with_key(client, voucherid, state, key):
+    return client.patch(
+        f"/api/vouchers/{voucherid}",
+        json={"state": state},
+        headers={"Idempotency-Key": key},
+    )
+
+
+def test_vouchers_patch__idempotency_key(con, distributor_client, voucher_distributed):
+    voucherid = voucher_distributed.id
+    first = _patch_with_key(distributor_client, voucherid, 0, "cancel-1")
+    assert first.status_code == status.HTTP_200_OK
+    history = main.get_voucher_history(con, voucherid)
+
+    statements = []
+    con.set_trace_callback(statements.append)
+    retry = _patch_with_key(distributor_client, voucherid, 0, "cancel-1")
+    con.set_trace_callback(None)
+    assert retry.status_code == status.HTTP_200_OK
+    assert retry.json() == first.json()
+    assert len(statements) == 1
+    assert main.get_voucher_history(con, voucherid) == history
+
+
+def test_vouchers_patch__idempotency_key__other_scan(
+    con, distributor_client, voucher_registered, voucher_distributed
+):
+    _patch_with_key(distributor_client, voucher_registered.id, 1, "key")
+    history = main.get_voucher_history(con, voucher_registered.id)
+    for voucherid, state in (
+        (voucher_registered.id, 0),
+        (voucher_distributed.id, 1),
+    ):
+        response = _patch_with_key(distributor_client, voucherid, state, "key")
+        assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert main.get_voucher_history(con, voucher_registered.id) == history
+
+
+def test_vouchers_patch__idempotency_key__scoped_and_expiring(
+    monkeypatch, con, distributor_client, cashier_client, voucher_registered
+):
+    voucherid = voucher_registered.id
+    _patch_with_key(distributor_client, voucherid, 1, "key")
+    response = _patch_with_key(cashier_client, voucherid, 2, "key")
+    assert response.json()["voucher"]["state"] == 2
+
+    # Expired: the scan is applied again, here without effect
+    monkeypatch.setattr(main.config, "IDEMPOTENCY_KEY_TTL", 0)
+    response = _patch_with_key(distributor_client, voucherid, 1, "key")
+    assert response.json()["voucher"]["state"] == 2
+    assert con.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0] == 1
+
+
+def test_scan_voucher_idempotent__concurrent_retry(
+    monkeypatch, con, user_distributor, voucher_registered
+):
+    # A concurrent retry commits between our key lookup and our scan
+    lookup = main.get_idempotent_response
+
+    def get_idempotent_response(con, user, key, voucherid, state):
+        monkeypatch.setattr(main, "get_idempotent_response", lookup)
+        with con:
+            main._store_idempotent_response(
+                con, user, key, voucherid, state, '{"concurrent": true}'
+            )
+        return None
+
+    monkeypatch.setattr(main, "get_idempotent_response", get_idempotent_response)
+    response = main.scan_voucher_idempotent(
+        con, user_distributor, voucher_registered.id, main.VoucherPatch(state=1), "k"
+    )
+    assert response == '{"concurrent": true}'
+    assert main.get_voucher(con, voucher_registered.id)["state"] == 0
+
+
+def test_reports__report_csv(
+    monkeypatch, admin_client, voucher_registered, voucher_spent
+):
+    monkeypatch.setattr(main.config, "REPORT_FETCH_SIZE", 1)
+    response = admin_client.get("/api/reports/report.csv")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/csv")
+    header, *rows = csv.reader(io.StringIO(response.text))
+    assert header[:4] == [
+        "expiration_date",
+        "voucher_id",
+        "value_in_dollars",
+        "last_state",
+    ]
+    assert sorted((row[1], row[3]) for row in rows) == sorted(
+        [(voucher_registered.id, "registered"), (voucher_spent.id, "cashedin")]
+    )
+
+
+def test_reports__history_ndjson__filters(
+    admin_client, voucher_distributed, voucher_spent
+):
+    response = admin_client.get("/api/reports/history.ndjson?state=cashedin")
+    assert response.status_code == status.HTTP_200_OK
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["voucher"] for row in rows] == [voucher_spent.id]
+    assert rows[0]["user"] == "A cashier user"
+
+    # History dates are UTC: keep a day of margin around the local date
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    response = admin_client.get(f"/api/reports/history.ndjson?since={yesterday}")
+    assert len(response.text.splitlines()) == 5
+    response = admin_client.get(
+        f"/api/reports/history.ndjson?until={yesterday - datetime.timedelta(days=1)}"
+    )
+    assert response.text == ""
+
+
+def test_reports__not_admin(distributor_client):
+    response = distributor_client.get("/api/reports/report.csv")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_reports__unknown(admin_client):
+    response = admin_client.get("/api/reports/vouchers.csv")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = admin_client.get("/api/reports/report.xlsx")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_vouchers_qrcode(distributor_client, voucher_registered):
+    url = f"/api/vouchers/{voucher_registered.id}/qrcode.svg"
+    response = distributor_client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"] == "image/svg+xml"
+    assert response.content.startswith(b"<?xml")
+    etag = response.headers["etag"]
+
+    response = distributor_client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.headers["etag"] == etag
+    response = distributor_client.get(url, headers={"If-None-Match": '"other"'})
+    assert response.status_code == status.HTTP_200_OK
+
+    response = distributor_client.get(url.replace(".svg", ".png"))
+    assert response.content.startswith(b"\x89PNG")
+    assert response.headers["etag"] != etag
+
+
+def test_vouchers_qrcode__unknown(distributor_client, voucher_registered):
+    response = distributor_client.get("/api/vouchers/unknown/qrcode.svg")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    response = distributor_client.get(
+        f"/api/vouchers/{voucher_registered.id}/qrcode.gif"
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_vouchers_qrcode__unauthenticated(unauthenticated_client, voucher_registered):
+    response = unauthenticated_client.get(
+        f"/api/vouchers/{voucher_registered.id}/qrcode.svg"
+    )
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_metrics(con, distributor_client, voucher_registered):
+    # Metrics are global: compare with their values before the requests
+    route = "PATCH", "/api/vouchers/{voucherid}"
+    transition = 1, 0, 0, 1
+    before = (
+        main.http_requests.value(*route, 200),
+        main.http_requests.value(*route, 404),
+        main.http_request_db_seconds.count(*route),
+        main.scan_seconds.count(*transition),
+    )
+    distributor_client.patch(
+        f"/api/vouchers/{voucher_registered.id}", json={"state": 1}
+    )
+    distributor_client.patch("/api/vouchers/unknown", json={"state": 1})
+    after = (
+        main.http_requests.value(*route, 200),
+        main.http_requests.value(*route, 404),
+        main.http_request_db_seconds.count(*route),
+        main.scan_seconds.count(*transition),
+    )
+    assert [b - a for a, b in zip(before, after)] == [1, 1, 2, 1]
+
+    response = distributor_client.get("/metrics")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert (
+        'ldtvouchers_scan_duration_seconds_count{ac_distribute="1",ac_cashin="0",'
+        f'cur_state="0",next_state="1"}} {after[3]}'
+    ) in lines
+    assert "# TYPE ldtvouchers_db_pool_connections_in_use gauge" in lines
+
+
+def test_sql_trace(monkeypatch, caplog, con_uri, app, user_distributor):
+    monkeypatch.setattr(main.config, "SQL_TRACE", True)
+    monkeypatch.setattr(main.config, "SLOW_QUERY_SECONDS", 0)
+    traced_con = main.init_con(con_uri)
+
+    def get_con():
+        yield traced_con
+
+    app.dependency_overrides[main.get_con] = get_con
+    client = TestClient(app)
+    client.auth = BearerAuth(user_distributor.id)
+    with caplog.at_level("WARNING", logger="ldtvouchers.sql"):
+        response = client.get("/api/auth")
+    assert response.status_code == status.HTTP_200_OK
+    timing = response.headers["server-timing"]
+    assert timing.startswith("sql;dur=") and "sql-1;dur=" in timing
+    assert any("SEARCH users" in record.getMessage() for record in caplog.records)
+    traced_con.close()
+
+
+def test_import__has_no_side_effects(tmpdir):
+    result = subprocess.run(
+        [sys.executable, "-c", "import app.main"],
+        cwd=tmpdir,
+        env={"PYTHONPATH": str(pathlib.Path(__file__).parent.parent)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout == ""
+    assert tmpdir.listdir() == []
+
+
+def test_create_app__lifespan(monkeypatch, tmpdir):
+    # startup() replaces the pool and database path of the module
+    monkeypatch.setattr(main, "pool", main.pool)
+    monkeypatch.setattr(main, "DB_PATH", main.DB_PATH)
+    db_path = tmpdir / "db.sqlite3"
+    app = main.create_app(db_path, serve_static_files=False)
+    assert not db_path.exists()
+
+    with TestClient(app) as client:
+        assert main.DB_PATH == pathlib.Path(db_path)
+        assert client.get("/api/start").status_code == status.HTTP_200_OK
+        with main.pool.connection() as con:
+            version = migrations.schema_version(con)
+        assert version == len(migrations.MIGRATIONS)
+        assert client.get("/").status_code == status.HTTP_404_NOT_FOUND
+    with raises(RuntimeError):
+        main.pool.checkout()
+
+
+def test_reserve_voucher_ids(con):
+    with con:
+        assert main.utils.reserve_voucher_ids(con.cursor(), 3) == range(1, 4)
+        assert main.utils.reserve_voucher_ids(con.cursor()) == range(4, 5)
+
+
+def test_users__get(admin_client, user_cashier):
+    response = admin_client.get(f"/api/users/{user_cashier.id}")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == user_cashier.dict()
+
+
+def test_users__get__unknown_user_id(admin_client):
+    response = admin_client.get("/api/users/unknown_user_id")
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_users__get__not_admin(unauthenticated_client, cashier_client, user_cashier):
+    response = unauthenticated_client.get(f"/api/users/{user_cashier.id}")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    response = cashier_client.get(f"/api/users/{user_cashier.id}")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_users__post(con, admin_client):
+    response = admin_client.post(
+        "/api/users",
+        json={
+            "name": "POS 2",
+            "description": "A cashier",
+            "ac_distribute": False,
+            "ac_cashin": True,
+        },
+    )
+    assert response.status_code == status.HTTP_200_OK
+    user = main.User(**response.json())
+    assert (user.name, user.ac_distribute, user.ac_cashin) == ("POS 2", False, True)
+    assert main.get_user(con, user.id)
+
+
+def test_users__post__not_admin(unauthenticated_client, distributor_client):
+    admin = {
+        "name": "Admin",
+        "description": "",
+        "ac_distribute": True,
+        "ac_cashin": True,
+    }
+    response = unauthenticated_client.post("/api/users", json=admin)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    response = distributor_client.post("/api/users", json=admin)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
 def test_start(unauthenticated_client):
     response = unauthenticated_client.get("/api/start")
     assert response.status_code == status.HTTP_200_OK
@@ -0,0 +1,43 @@
+from pytest import raises
+
+from app import metrics
+
+
+def test_counter():
+    registry = metrics.Registry()
+    counter = registry.register(
+        metrics.Counter("requests_total", "Requests", ("route", "status"))
+    )
+    counter.inc("/a", 200)
+    counter.inc("/a", 200, amount=2)
+    counter.inc('/"b"', 500)
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{route="/\\"b\\"",status="500"} 1.0\n'
+        'requests_total{route="/a",status="200"} 3.0\n'
+    )
+    with raises(ValueError):
+        counter.inc("/a")
+
+
+def test_gauge():
+    registry = metrics.Registry()
+    registry.register(metrics.Gauge("in_use", "In use", lambda: 3))
+    assert registry.render().splitlines()[-1] == "in_use 3.0"
+
+
+def test_histogram():
+    registry = metrics.Registry()
+    histogram = registry.register(
+        metrics.Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1))
+    )
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value, "/a")
+    assert registry.render().splitlines()[2:] == [
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1.0"} 3',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 4',
+        'latency_seconds_sum{route="/a"} 2.65',
+        'latency_seconds_count{route="/a"} 4',
+    ]
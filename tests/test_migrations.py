@@ -0,0 +1,88 @@
+import sqlite3
+
+from pytest import fixture, raises
+
+from app import migrations
+
+
+@fixture
+def con(tmpdir):
+    con = sqlite3.connect(tmpdir / "db.sqlite3")
+    yield con
+    con.close()
+
+
+def _tables(con):
+    cur = con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {name for name, in cur}
+
+
+def test_migrate__fresh_database(con):
+    assert migrations.schema_version(con) == 0
+    assert migrations.migrate(con) == len(migrations.MIGRATIONS)
+    assert migrations.schema_version(con) == len(migrations.MIGRATIONS)
+    assert {"users", "vouchers", "history", "states"} <= _tables(con)
+
+
+def test_migrate__is_idempotent(con):
+    migrations.migrate(con)
+    con.execute("DELETE FROM states")
+    con.commit()
+    migrations.migrate(con)
+    assert con.execute("SELECT COUNT(*) FROM states").fetchone() == (0,)
+
+
+def test_migrate__legacy_database(con):
+    # Databases created before migrations existed are at version 0
+    for statement in migrations._statements(migrations.MIGRATIONS[0]):
+        con.execute(statement)
+    con.commit()
+    assert migrations.migrate(con) == len(migrations.MIGRATIONS)
+
+
+def test_migrate__failure_rolls_back(con):
+    with raises(sqlite3.OperationalError):
+        migrations.migrate(con, ["CREATE TABLE a (x);", "CREATE TABLE a (x);"])
+    assert migrations.schema_version(con) == 0
+    assert "a" not in _tables(con)
+
+
+def test_migrate__newer_database(con):
+    con.execute("PRAGMA user_version = 1000")
+    with raises(RuntimeError):
+        migrations.migrate(con)
+
+
+def test_migrate__voucher_sequence_after_existing_ids(con):
+    migrations.migrate(con, migrations.MIGRATIONS[:2])
+    con.executemany(
+        "INSERT INTO vouchers VALUES (?, '', '2030-01-01', 20, 0)",
+        [("0007-ABCDE",), ("0012-FGHIJ",), ("legacy",)],
+    )
+    con.commit()
+    migrations.migrate(con)
+    assert con.execute("SELECT value FROM sequences").fetchone() == (12,)
+
+
+def test_migrate__history_ids_keep_rowids(con):
+    migrations.migrate(con, migrations.MIGRATIONS[:4])
+    con.execute("INSERT INTO users VALUES ('admin', 'ADMIN', 'An admin', 1, 1)")
+    con.execute("INSERT INTO vouchers VALUES ('0001-A', '', '2030-01-01', 20, 0)")
+    con.executemany(
+        "INSERT INTO history VALUES (?, 'admin', '0001-A', ?)",
+        [("2024-01-01 10:00:00", 0), ("2024-01-01 10:00:00", 1)],
+    )
+    con.execute("DELETE FROM history WHERE rowid = 1")
+    con.commit()
+    migrations.migrate(con)
+    assert con.execute("SELECT id, state FROM history").fetchall() == [(2, 1)]
+    # Triggers still maintain the report, and ids are never reused
+    con.execute("DELETE FROM history")
+    con.execute(
+        "INSERT INTO history(date, userid, voucherid, state) "
+        "VALUES ('2024-01-02 10:00:00', 'admin', '0001-A', 2)"
+    )
+    assert con.execute("SELECT id FROM history").fetchall() == [(3,)]
+    assert con.execute("SELECT last_state FROM voucher_report").fetchone() == (
+        "cashedin",
+    )
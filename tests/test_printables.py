@@ -0,0 +1,277 @@
+import base64
+import pathlib
+import sqlite3
+import xml.etree.ElementTree as ET
+
+import pypdf
+
+from pypdf.generic import DictionaryObject, NameObject, NumberObject, StreamObject
+from pytest import fixture
+
+from app import migrations, printables, qrcodes, states
+
+TEMPLATES_DIR = pathlib.Path(__file__).parent.parent / "templates" / "printables"
+
+_XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+_SVG_IMAGE = "{http://www.w3.org/2000/svg}image"
+
+
+@fixture
+def vouchers():
+    return [
+        {"id": f"{i:04d}-ABCDE", "label": "Camp", "value": 20, "state": 0}
+        for i in range(1, 8)
+    ]
+
+
+@fixture
+def env():
+    return printables.environment(TEMPLATES_DIR)
+
+
+@fixture
+def con(tmpdir):
+    con = sqlite3.connect(tmpdir / "db.sqlite3")
+    migrations.migrate(con)
+    with con:
+        con.executemany(
+            "INSERT INTO vouchers VALUES (?, ?, ?, 20, ?)",
+            [
+                ("0001-A", "Summer", "2030-01-01", 0),
+                ("0002-B", "Fall", "2030-01-01", 1),
+                ("0003-C", "Summer", "2031-01-01", 0),
+                ("0004-D", "Fall", "2030-01-01", 0),
+            ],
+        )
+    yield con
+    con.close()
+
+
+def _ids(cur):
+    return [row[0] for row in cur]
+
+
+def test_select_vouchers(con):
+    # By campaign, then in insertion order
+    assert _ids(printables.select_vouchers(con)) == [
+        "0002-B",
+        "0004-D",
+        "0001-A",
+        "0003-C",
+    ]
+    assert _ids(printables.select_vouchers(con, label="Summer")) == [
+        "0001-A",
+        "0003-C",
+    ]
+    assert _ids(
+        printables.select_vouchers(
+            con, expiration_date="2030-01-01", state="registered"
+        )
+    ) == ["0004-D", "0001-A"]
+    assert _ids(printables.select_vouchers(con, after="0004-D")) == [
+        "0001-A",
+        "0003-C",
+    ]
+
+
+def test_select_vouchers__history_store(con):
+    # Scans only append to history, vouchers.state stays as emitted
+    states.use_store(con, "history")
+    with con:
+        con.execute("""
+            INSERT INTO history(date, userid, voucherid, state)
+            VALUES (DATETIME('now'), 'user', '0001-A', 1)
+            """)
+    assert _ids(printables.select_vouchers(con, state="registered")) == [
+        "0004-D",
+        "0003-C",
+    ]
+    assert _ids(printables.select_vouchers(con, state="distributed")) == [
+        "0002-B",
+        "0001-A",
+    ]
+
+
+def test_select_vouchers__streams_without_sort(con):
+    sql = []
+    con.set_trace_callback(sql.append)
+    printables.select_vouchers(con, state="registered", after="0001-A")
+    con.set_trace_callback(None)
+    plan = con.execute("EXPLAIN QUERY PLAN " + sql[-1]).fetchall()
+    assert not any("TEMP B-TREE" in detail for *_, detail in plan)
+
+
+def test_group():
+    assert list(printables.group(range(5), 2)) == [(0, 1), (2, 3), (4,)]
+
+
+def test_voucher_sheets(vouchers):
+    first, second = printables.voucher_sheets(vouchers, "2024-01-01")
+    assert first.root == pathlib.Path("tmp/vouchers/Camp-Camp-0001-ABCDE-0006-ABCDE")
+    assert [v["qrcode"] for v in first.items][:2] == [
+        "qrcode-0001-ABCDE.svg",
+        "qrcode-0002-ABCDE.svg",
+    ]
+    assert (first.data["av"], first.data["fi"]) == ("20$", "0006-ABCDE")
+    # The last sheet is padded with empty vouchers
+    assert (second.data["ai"], second.data["bi"], second.data["bc"]) == (
+        "0007-ABCDE",
+        "",
+        "empty.svg",
+    )
+
+
+def test_qrcodes_data_uri():
+    uri = qrcodes.data_uri("0001-ABCDE")
+    prefix = "data:image/svg+xml;base64,"
+    assert uri.startswith(prefix)
+    svg = ET.fromstring(base64.b64decode(uri[len(prefix) :]))
+    assert svg.tag == "{http://www.w3.org/2000/svg}svg"
+
+
+def test_render_svg__voucher_recto(env, vouchers):
+    sheet, _ = printables.voucher_sheets(vouchers, "2024-01-01")
+    recto, verso = printables.voucher_pages(sheet)
+    svg = ET.fromstring(printables.render_svg(env, recto))
+    hrefs = [image.get(_XLINK_HREF) for image in svg.iter(_SVG_IMAGE)]
+    assert "recto.png" in hrefs
+    assert sum(href.startswith("data:image/svg+xml") for href in hrefs) == 6
+    assert "0001-ABCDE" in ET.tostring(svg, encoding="unicode")
+    assert verso.qrcodes == {}
+
+
+def test_render_svg__user(env):
+    user = {"id": "abcd", "name": "POS", "description": "A cashier"}
+    (sheet,) = printables.user_sheets([user], "2024-01-01")
+    (page,) = printables.user_pages(sheet)
+    assert page.size == printables.PORTRAIT
+    svg = printables.render_svg(env, page)
+    assert "A cashier" in svg
+    assert 'xlink:href="data:image/svg+xml;base64,' in svg
+
+
+def test_write_if_changed(tmp_path):
+    path = tmp_path / "data.json"
+    assert printables.write_if_changed(path, "{}")
+    mtime = path.stat().st_mtime_ns
+    assert not printables.write_if_changed(path, "{}")
+    assert path.stat().st_mtime_ns == mtime
+    assert printables.write_if_changed(path, "[]")
+    assert path.read_text() == "[]"
+
+
+def test_page_digest(tmp_path, vouchers):
+    (tmp_path / "vouchers").mkdir()
+    (tmp_path / "vouchers" / "recto.svg").write_text("<svg/>")
+    first, second = printables.voucher_sheets(vouchers, "2024-01-01")
+    recto, verso = printables.voucher_pages(first)
+    digest = printables.page_digest(recto, tmp_path)
+    assert digest == printables.page_digest(
+        printables.voucher_pages(first)[0], tmp_path
+    )
+    assert digest != printables.page_digest(verso, tmp_path)
+    assert digest != printables.page_digest(
+        printables.voucher_pages(second)[0], tmp_path
+    )
+
+    # Any file next to the template, e.g. an image it links to
+    printables._directory_digest.cache_clear()
+    (tmp_path / "vouchers" / "recto.png").write_bytes(b"png")
+    assert digest != printables.page_digest(recto, tmp_path)
+
+
+def test_render__cached(tmp_path, env, vouchers):
+    sheet, _ = printables.voucher_sheets(vouchers, "2024-01-01")
+    pages = [printables.shared(env, page) for page in printables.voucher_pages(sheet)]
+    cached = [
+        tmp_path / f"{printables.page_digest(page, TEMPLATES_DIR)}.pdf"
+        for page in pages
+    ]
+    for path in cached:
+        path.write_bytes(b"%PDF")
+    stale = tmp_path / "stale.pdf"
+    stale.write_bytes(b"%PDF")
+
+    # Nothing to render: the cached PDFs are returned as is
+    assert (
+        printables.render(pages, TEMPLATES_DIR, tmp_path, jobs=1, progress=None)
+        == cached
+    )
+    assert printables.prune(tmp_path, cached) == 1
+    assert not stale.exists()
+
+
+def test_is_static(env):
+    assert printables.is_static(env, "vouchers/verso.svg")
+    assert not printables.is_static(env, "vouchers/recto.svg")
+    assert not printables.is_static(env, "users/page.svg")
+
+
+def test_template_assets(env):
+    assert printables.template_assets(env, "vouchers/recto.svg") == ["recto.png"]
+    assert printables.template_assets(env, "vouchers/verso.svg") == ["verso.png"]
+
+
+def test_render__static_pages_are_shared(tmp_path, env, vouchers):
+    pages = [
+        printables.shared(env, page)
+        for sheet in printables.voucher_sheets(vouchers, "2024-01-01")
+        for page in printables.voucher_pages(sheet)
+    ]
+    digests = [printables.page_digest(page, TEMPLATES_DIR) for page in pages]
+    # Both versos share one digest
+    assert digests[1] == digests[3] and len(set(digests)) == 3
+    for digest in digests:
+        (tmp_path / f"{digest}.pdf").write_bytes(b"%PDF")
+
+    paths = printables.render(pages, TEMPLATES_DIR, tmp_path, jobs=1, progress=None)
+    assert paths[1] == paths[3]
+
+
+def _page_pdf(path, content, image):
+    # A page drawing an RGB image, as the page PDFs draw their background
+    writer = pypdf.PdfWriter()
+    page = writer.add_blank_page(100, 100)
+    xobject = StreamObject()
+    xobject.set_data(image)
+    xobject.update(
+        {
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Image"),
+            NameObject("/Width"): NumberObject(16),
+            NameObject("/Height"): NumberObject(len(image) // 48),
+            NameObject("/ColorSpace"): NameObject("/DeviceRGB"),
+            NameObject("/BitsPerComponent"): NumberObject(8),
+        }
+    )
+    page[NameObject("/Resources")] = DictionaryObject(
+        {
+            NameObject("/XObject"): DictionaryObject(
+                {NameObject("/Im0"): writer._add_object(xobject)}
+            )
+        }
+    )
+    contents = StreamObject()
+    contents.set_data(f"q 100 0 0 100 0 0 cm /Im0 Do Q % {content}".encode())
+    page[NameObject("/Contents")] = writer._add_object(contents)
+    writer.write(path)
+
+
+def test_unite__shares_identical_objects(tmp_path):
+    image = bytes(range(48)) * 256
+    paths = []
+    for i in range(3):
+        paths.append(tmp_path / f"{i}.pdf")
+        _page_pdf(paths[-1], i, image)
+    # The same page twice, as the shared verso
+    paths.append(paths[0])
+
+    output = tmp_path / "vouchers.pdf"
+    printables.unite(paths, output)
+    reader = pypdf.PdfReader(output)
+    assert len(reader.pages) == 4
+    images = {
+        page["/Resources"]["/XObject"].raw_get("/Im0").idnum for page in reader.pages
+    }
+    assert len(images) == 1
+    assert output.stat().st_size < 2 * paths[0].stat().st_size
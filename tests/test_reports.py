@@ -0,0 +1,147 @@
+import csv
+import io
+import sqlite3
+
+from pytest import fixture
+
+from app import migrations, reports
+
+
+@fixture
+def con(tmpdir):
+    con = sqlite3.connect(tmpdir / "db.sqlite3")
+    con.row_factory = sqlite3.Row
+    migrations.migrate(con)
+    with con:
+        con.executemany(
+            "INSERT INTO users VALUES (?, ?, ?, 1, 1)",
+            [("admin", "ADMIN", "An admin"), ("pos", "POS", "A cashier")],
+        )
+        con.executemany(
+            "INSERT INTO vouchers VALUES (?, '', '2030-01-01', 20, 0)",
+            [("0001-A",), ("0002-B",), ("0003-C",)],
+        )
+        con.executemany(
+            "INSERT INTO history(date, userid, voucherid, state) VALUES (?, ?, ?, ?)",
+            [
+                ("2024-01-01 10:00:00", "admin", "0001-A", 0),
+                ("2024-01-01 10:00:00", "admin", "0002-B", 0),
+                # Same date: insertion order wins
+                ("2024-01-01 10:00:00", "admin", "0002-B", 1),
+                ("2024-01-02 10:00:00", "pos", "0002-B", 2),
+                # Backdated, and by an unknown user
+                ("2024-01-01 09:00:00", "pos", "0002-B", 1),
+                ("2024-01-03 10:00:00", "unknown", "0003-C", 1),
+            ],
+        )
+    yield con
+    con.close()
+
+
+def _report(con, voucherid):
+    cur = con.execute("SELECT * FROM voucher_report WHERE voucher_id=?", (voucherid,))
+    return dict(cur.fetchone())
+
+
+def test_voucher_report__maintained_by_triggers(con):
+    assert reports.check(con) == []
+    assert _report(con, "0002-B") == {
+        "expiration_date": "2030-01-01",
+        "voucher_id": "0002-B",
+        "value_in_dollars": 20,
+        "last_state": "cashedin",
+        "last_state_date": "2024-01-02 10:00:00",
+        "last_state_by": "A cashier",
+        "last_registered_date": "2024-01-01 10:00:00",
+        "last_registered_by": "An admin",
+        "last_distributed_date": "2024-01-01 10:00:00",
+        "last_distributed_by": "An admin",
+        "last_cashedin_date": "2024-01-02 10:00:00",
+        "last_cashedin_by": "A cashier",
+    }
+    assert _report(con, "0003-C")["last_state_by"] is None
+    assert _report(con, "0003-C")["last_distributed_date"] is None
+
+
+def test_voucher_report__voucher_changes(con):
+    with con:
+        con.execute("UPDATE vouchers SET value = 50 WHERE id = '0001-A'")
+        con.execute("DELETE FROM vouchers WHERE id = '0003-C'")
+    assert reports.check(con) == []
+    assert _report(con, "0001-A")["value_in_dollars"] == 50
+
+
+def test_voucher_report__check_and_rebuild(con):
+    with con:
+        con.execute("DELETE FROM history WHERE voucherid = '0002-B' AND state = 2")
+    problems = reports.check(con)
+    assert [(row["problem"], row["voucher_id"]) for row in problems] == [
+        ("missing", "0002-B"),
+        ("unexpected", "0002-B"),
+    ]
+    assert reports.rebuild(con) == 3
+    assert reports.check(con) == []
+    assert _report(con, "0002-B")["last_state"] == "distributed"
+
+
+def _export(con, **kwargs):
+    report, history = io.StringIO(), io.StringIO()
+    run = reports.export(con, report, history, **kwargs)
+    return (
+        run,
+        list(csv.DictReader(io.StringIO(report.getvalue()))),
+        list(csv.DictReader(io.StringIO(history.getvalue()))),
+    )
+
+
+def test_export__incremental(con):
+    run, report, history = _export(con)
+    assert (run["full"], run["since_history_id"], run["last_history_id"]) == (0, 0, 6)
+    assert [row["voucher_id"] for row in report] == ["0001-A", "0002-B", "0003-C"]
+    assert len(history) == 6
+    assert history[0] == {
+        "date": "2024-01-01 10:00:00",
+        "user": "An admin",
+        "voucher": "0001-A",
+        "state": "registered",
+    }
+
+    run, report, history = _export(con)
+    assert (run["since_history_id"], report, history) == (6, [], [])
+
+    with con:
+        con.execute(
+            "INSERT INTO history(date, userid, voucherid, state) "
+            "VALUES ('2024-01-04 10:00:00', 'pos', '0003-C', 2)"
+        )
+    run, report, history = _export(con)
+    assert (run["report_rows"], run["history_rows"]) == (1, 1)
+    assert report[0]["voucher_id"] == "0003-C"
+    assert report[0]["last_state"] == "cashedin"
+    assert history[0]["voucher"] == "0003-C"
+
+
+def test_export__full(con):
+    _export(con)
+    assert reports.full_export_due(con, 7)
+    run, report, history = _export(con, full=True)
+    assert (run["full"], len(report), len(history)) == (1, 3, 6)
+    assert not reports.full_export_due(con, 7)
+    with con:
+        con.execute("UPDATE report_exports SET date = '2000-01-01'")
+    assert reports.full_export_due(con, 7)
+
+
+def test_export__pending(con):
+    run, report, history = _export(con, commit=False)
+    assert (run["committed"], len(history)) == (0, 6)
+    # Not delivered: the next run exports the same rows again
+    run, report, history = _export(con, full=True, commit=False)
+    assert reports.full_export_due(con, 7)
+    run, report, history = _export(con, commit=False)
+    assert (run["since_history_id"], len(history)) == (0, 6)
+
+    assert reports.commit_export(con, run["id"])
+    assert not reports.commit_export(con, run["id"] + 1)
+    run, report, history = _export(con)
+    assert (run["since_history_id"], report, history) == (6, [], [])
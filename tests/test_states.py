@@ -0,0 +1,86 @@
+import sqlite3
+
+from pytest import fixture
+
+from app import migrations, states
+
+
+@fixture
+def con(tmpdir):
+    con = sqlite3.connect(tmpdir / "db.sqlite3")
+    migrations.migrate(con)
+    with con:
+        con.execute("INSERT INTO users VALUES ('admin', 'ADMIN', 'An admin', 1, 1)")
+        con.executemany(
+            "INSERT INTO vouchers VALUES (?, '', '2030-01-01', 20, 0)",
+            [("0001-A",), ("0002-B",)],
+        )
+        con.executemany(
+            "INSERT INTO history(date, userid, voucherid, state) "
+            "VALUES (?, 'admin', ?, ?)",
+            [
+                ("2024-01-01 10:00:00", "0001-A", 0),
+                ("2024-01-01 10:00:00", "0002-B", 0),
+                ("2024-01-02 10:00:00", "0002-B", 1),
+                # Backdated: insertion order wins
+                ("2024-01-01 09:00:00", "0002-B", 2),
+            ],
+        )
+    yield con
+    con.close()
+
+
+def test_latest_state(con):
+    assert states.latest_state(con, "0001-A") == 0
+    assert states.latest_state(con, "0002-B") == 2
+    assert states.latest_state(con, "unknown") is None
+
+
+def test_latest_state__uses_covering_index(con):
+    plan = con.execute(
+        "EXPLAIN QUERY PLAN SELECT state FROM history "
+        "WHERE voucherid = '0001-A' ORDER BY id DESC LIMIT 1"
+    ).fetchall()
+    assert "COVERING INDEX history_voucherid_id_state" in plan[0][-1]
+
+
+def test_append_state(con):
+    with con:
+        assert states.append_state(con, "admin", "0001-A", 0, 1)
+        assert not states.append_state(con, "admin", "0001-A", 0, 1)
+    assert states.latest_state(con, "0001-A") == 1
+    assert con.execute("SELECT COUNT(*) FROM history").fetchone() == (5,)
+    # vouchers.state is left untouched
+    assert con.execute("SELECT state FROM vouchers WHERE id = '0001-A'").fetchone() == (
+        0,
+    )
+
+
+def test_use_store__syncs_when_leaving_history(con):
+    assert states.use_store(con, "column") == 0
+    assert states.use_store(con, "history") == 0
+    assert states.use_store(con, "column") == 1
+    assert con.execute("SELECT id, state FROM vouchers").fetchall() == [
+        ("0001-A", 0),
+        ("0002-B", 2),
+    ]
+
+
+def test_latest_states(con):
+    latest = states.LatestStates()
+    assert latest.warm(con) == 2
+    assert latest.get(con, "0002-B") == 2
+
+    # Appended by another process
+    with con:
+        states.append_state(con, "admin", "0001-A", 0, 1)
+        con.execute("INSERT INTO vouchers VALUES ('0003-C', '', '2030-01-01', 20, 0)")
+        con.execute(
+            "INSERT INTO history(date, userid, voucherid, state) "
+            "VALUES ('2024-01-03 10:00:00', 'admin', '0003-C', 0)"
+        )
+    assert latest.get(con, "0001-A") == 0
+    assert latest.refresh(con, "0001-A") == 1
+    assert latest.get(con, "0003-C") == 0
+    assert latest.get(con, "unknown") is None
+    assert len(latest) == 3
@@ -0,0 +1,60 @@
+import logging
+import sqlite3
+
+from pytest import fixture
+
+from app import tracing
+
+
+@fixture
+def con():
+    con = sqlite3.connect(":memory:", factory=tracing.TracingConnection)
+    con.execute("CREATE TABLE t(id INTEGER PRIMARY KEY, value INTEGER)")
+    yield con
+    con.close()
+
+
+def _work(con):
+    with con:
+        con.executemany("INSERT INTO t(value) VALUES (?)", ((i,) for i in range(10)))
+    rows = con.execute("SELECT * FROM t WHERE value > ?", (4,)).fetchall()
+    return len(rows) + sum(1 for _ in con.execute("SELECT * FROM t WHERE id < 3"))
+
+
+def test_traced(con):
+    trace = tracing.Trace()
+    assert tracing.traced(trace, _work, con) == 7
+    assert [(s.sql, s.rows) for s in trace.statements] == [
+        ("INSERT INTO t(value) VALUES (?)", 10),
+        # The COMMIT of `with con:` is only seen by the trace callback
+        ("COMMIT", 0),
+        ("SELECT * FROM t WHERE value > ?", 5),
+        ("SELECT * FROM t WHERE id < 3", 2),
+    ]
+    assert all(statement.seconds > 0 for statement in trace.statements)
+    assert trace.rows == 17
+
+    # Out of traced(), statements are not recorded
+    _work(con)
+    assert len(trace.statements) == 4
+
+
+def test_trace__server_timing():
+    trace = tracing.Trace()
+    trace.statements = [
+        tracing.Statement("SELECT 1", 0.001, 1),
+        tracing.Statement('SELECT "a"\n  FROM b', 0.002, 2),
+    ]
+    assert trace.server_timing(slowest=1) == (
+        'sql;dur=3.00;desc="2 statements, 3 rows", '
+        "sql-1;dur=2.00;desc=\"SELECT 'a' FROM b\""
+    )
+
+
+def test_slow_query_log(con, caplog):
+    con.slow_query_seconds = 0
+    with caplog.at_level(logging.WARNING, logger="ldtvouchers.sql"):
+        con.execute("SELECT * FROM t WHERE id = ?", (1,)).fetchall()
+    (record,) = caplog.records
+    assert "SELECT * FROM t WHERE id = ?" in record.getMessage()
+    assert "SEARCH t USING INTEGER PRIMARY KEY (rowid=?)" in record.getMessage()